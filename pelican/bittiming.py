@@ -0,0 +1,115 @@
+# Pelican - MCP2515 bit timing solver
+# Author: Oleksandr Ivanchuk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+from typing import Optional
+
+
+CRYSTALS = (8, 16, 20)  # Crystal oscillators [MHz] in the generated table.
+SPEEDS = (5, 10, 20, 33, 40, 50, 80, 95, 100, 125, 200, 250, 500, 1000)
+# Communication speeds [Kb/s] in the generated table.
+
+BITRATES = {33: 100000 / 3}  # Bitrates [b/s] of the speeds named by their
+# rounded value.
+
+SAMPLE_POINT = 0.875  # Recommended by CiA for the speeds up to 800 Kb/s.
+TOLERANCE = 0.015  # Maximal bitrate error, CAN allows up to 1.58 %.
+
+BEGIN = '# BEGIN BIT TIMING TABLE\n'
+END = '# END BIT TIMING TABLE\n'
+
+
+def solve(crystal: int, speed: int,
+          sample_point: float = SAMPLE_POINT,
+          tolerance: float = TOLERANCE) -> Optional[bytes]:
+    '''
+    Computes CNF3, CNF2, CNF1 register values (in order of their addresses)
+    for the crystal [MHz] and speed [Kb/s], or None if it is not reachable.
+
+    The bit consists of SyncSeg (1 TQ), PropSeg (1..8 TQ), PS1 (1..8 TQ)
+    and PS2 (2..8 TQ), 5..25 TQ in total, where TQ = 2 * (BRP + 1) / Fosc.
+    The lowest bitrate error wins, then the closest sample point, then the
+    finest resolution.
+    '''
+    bitrate = BITRATES.get(speed, speed * 1e3)
+    best = None
+    for brp in range(64):
+        tq_rate = crystal * 1e6 / (2 * (brp + 1))
+        tqs = round(tq_rate / bitrate)
+        if not 5 <= tqs <= 25:
+            continue
+        error = abs(tq_rate / tqs - bitrate) / bitrate
+        if error > tolerance:
+            continue
+
+        ps2 = max(2, min(8, round(tqs * (1 - sample_point))))
+        ps2 = max(ps2, tqs - 1 - 16)  # PropSeg and PS1 are up to 8 TQ each
+        prop = (tqs - 1 - ps2) // 2
+        ps1 = tqs - 1 - ps2 - prop
+        if prop < 1 or ps1 < 1 or prop + ps1 < ps2:
+            continue
+
+        point = (1 + prop + ps1) / tqs
+        key = (round(error, 6), abs(point - sample_point), -tqs)
+        if best is None or key < best[0]:
+            cnf1 = brp  # SJW = 1 TQ
+            cnf2 = 0x80 | (ps1 - 1) << 3 | (prop - 1)  # BTLMODE, SAM = 0
+            cnf3 = ps2 - 1
+            best = (key, bytes([cnf3, cnf2, cnf1]))
+
+    return None if best is None else best[1]
+
+
+def generate(crystals=CRYSTALS, speeds=SPEEDS) -> str:
+    '''
+    Renders the table of register values as micropython source.
+    '''
+    lines = [BEGIN,
+             '# Bit timing registers CNF3, CNF2, CNF1 by crystal [MHz] and\n',
+             '# speed [Kb/s]. Generated by `python -m pelican.bittiming`.\n',
+             'CNF = {\n']
+    for crystal in crystals:
+        lines.append(f'    {crystal}: {{\n')
+        for speed in speeds:
+            cfg = solve(crystal, speed)
+            if cfg is not None:
+                value = ''.join(f'\\x{byte:02x}' for byte in cfg)
+                lines.append(f"        {speed}: b'{value}',\n")
+        lines.append('    },\n')
+    lines += ['}\n', END]
+    return ''.join(lines)
+
+
+def update(path: str) -> None:
+    '''
+    Replaces the table in the board module with the generated one.
+    '''
+    with open(path, 'r') as module:
+        source = module.read()
+    head, rest = source.split(BEGIN)
+    _, tail = rest.split(END)
+    with open(path, 'w') as module:
+        module.write(head + generate() + tail)
+
+
+if __name__ == '__main__':
+    update(os.path.join(os.path.dirname(__file__), 'mcpcan.py'))
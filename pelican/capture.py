@@ -0,0 +1,123 @@
+# Pelican - Capture files
+# Author: Oleksandr Ivanchuk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import struct
+from typing import Iterator, List
+
+
+FRAME_SIZE = 17  # Raw Rx buffer with timestamp, as kept by `CAN.check_rx`.
+
+MAGIC = b'PLCN'
+VERSION = 1
+HEADER = struct.Struct('<4sHH8x')  # magic, version, record size
+
+RECORD = struct.Struct('<dIBB8s2x')
+# host time [s], id, flags, dlc, data; fixed size, so the files can be split
+# at any multiple of the record size.
+
+EXT = 0x01  # Record flags.
+RTR = 0x02
+TRIGGER = 0x04
+
+
+def decode(dat: bytes) -> dict:
+    '''
+    Converts the raw Rx buffer with timestamp to frame dict, the same way
+    `CAN.recv_msg` does on the board.
+    '''
+    frame: dict = {}
+    frame['tm'] = int.from_bytes(dat[13:17], 'big')
+    frame['dlc'] = dat[4] & 0x0F
+    frame['data'] = bytes(dat[5:13])
+    frame['ext'] = bool(dat[1] & 0x08)
+    id_s0_s10 = int.from_bytes(dat[:2], 'big') >> 5
+    if frame['ext']:
+        frame['id'] = ((id_s0_s10 << 18) + ((dat[1] & 0x03) << 16) +
+                       int.from_bytes(dat[2:4], 'big'))
+        frame['rtr'] = bool(dat[4] & 0x40)
+    else:
+        frame['id'] = id_s0_s10
+        frame['rtr'] = bool(dat[1] & 0x10)
+    return frame
+
+
+def split(window: bytes) -> Iterator[dict]:
+    '''
+    Decodes the bulk of raw frames uploaded by the board.
+    '''
+    for i in range(0, len(window) - FRAME_SIZE + 1, FRAME_SIZE):
+        yield decode(window[i:i + FRAME_SIZE])
+
+
+def write(path: str, frames: List[dict]) -> None:
+    '''
+    Appends the frames to the capture file, creating it if needed.
+    '''
+    new = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, 'ab') as capture:
+        if new:
+            capture.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        for frame in frames:
+            flags = ((EXT if frame['ext'] else 0) |
+                     (RTR if frame['rtr'] else 0) |
+                     (TRIGGER if frame.get('trigger') else 0))
+            capture.write(RECORD.pack(frame['host_tm'], frame['id'], flags,
+                                      frame['dlc'], frame['data']))
+
+
+def check(path: str) -> None:
+    '''
+    Raises ValueError if the file is not a capture file of this version.
+    '''
+    with open(path, 'rb') as capture:
+        head = capture.read(HEADER.size)
+    if len(head) < HEADER.size:
+        raise ValueError(f'{path} is not a capture file.')
+    magic, version, size = HEADER.unpack(head)
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+        raise ValueError(f'{path} is not a capture file of version '
+                         f'{VERSION}.')
+
+
+def unpack(record: bytes) -> dict:
+    '''
+    Converts the capture file record to frame dict.
+    '''
+    host_tm, can_id, flags, dlc, data = RECORD.unpack(record)
+    return {'host_tm': host_tm, 'id': can_id, 'ext': bool(flags & EXT),
+            'rtr': bool(flags & RTR), 'dlc': dlc, 'data': data,
+            'trigger': bool(flags & TRIGGER)}
+
+
+def read(path: str) -> Iterator[dict]:
+    '''
+    Reads the frames from the capture file.
+    '''
+    check(path)
+    with open(path, 'rb') as capture:
+        capture.seek(HEADER.size)
+        while True:
+            record = capture.read(RECORD.size)
+            if len(record) < RECORD.size:
+                break
+            yield unpack(record)
@@ -2,12 +2,52 @@ import click
 import yaml
 import os
 
-from pelican import pelican
+from pelican import capture, pelican, query as query_engine
+from pelican.link import Link
 from ampy import pyboard
 
 _board = None
+_link = None
 CONFIG_FILE = 'config.yaml'
 
+
+def _int(ctx, param, value):
+    '''
+    Converts the option to int, accepting hex (0x7DF) as well as decimal.
+    '''
+    try:
+        return None if value is None else int(value, 0)
+    except ValueError:
+        raise click.BadParameter(f'{value} is not a valid integer')
+
+
+def _ints(ctx, param, value):
+    '''
+    Converts the multiple option to tuple of int, accepting hex as well.
+    '''
+    return tuple(_int(ctx, param, item) for item in value)
+
+
+def _limits(ctx, param, value):
+    '''
+    Converts the multiple ID:HZ option to dict.
+    '''
+    try:
+        return {int(can_id, 0): int(hz) for can_id, hz in
+                (item.split(':') for item in value)}
+    except ValueError:
+        raise click.BadParameter('use ID:HZ, e.g. 0x123:10')
+
+
+def _hex(ctx, param, value):
+    '''
+    Converts the hex string option to bytes.
+    '''
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        raise click.BadParameter(f'{value} is not a valid hex string')
+
 @click.group()
 @click.option(
     "-p","--port",
@@ -21,13 +61,26 @@ CONFIG_FILE = 'config.yaml'
     type=click.INT,
     help="The baudrate for the communication.",
 )
+@click.option(
+    "-r", "--link-rate",
+    default=None,
+    type=click.INT,
+    help="Switch to this baudrate after connecting if the board keeps up.",
+)
 def cli(**kwargs):
     """peliCAN is a simple tool for CAN communication via micropython board.
 
     The tool is being utilized for sending and receiving CAN frames.
     """
-    global _board
+    global _board, _link
     _board = pyboard.Pyboard(kwargs['port'], baudrate=kwargs['baud'])
+    # The installed script runs `cli` directly, not `main`.
+    click.get_current_context().call_on_close(_close)
+    if kwargs['link_rate']:
+        _link = Link(_board)
+        rate = _link.negotiate((kwargs['link_rate'], ))
+        if rate != kwargs['link_rate']:
+            print(f'The board cannot keep up, staying at {rate} baud.')
 
 
 @cli.command()
@@ -129,6 +182,476 @@ def send(**kwargs):
     board.send(kwargs, CONFIG_FILE)
 
 
+@cli.command()
+@click.option(
+    '-i', '--id',
+    required=True,
+    callback=_int,
+    help='''The id of the request frame.'''
+)
+@click.option(
+    '-x', '--ext',
+    default=False,
+    type=click.BOOL,
+    help='''Whether the request is an extended frame.'''
+)
+@click.option(
+    '-d', '--data',
+    required=True,
+    callback=_hex,
+    help='''Data of the request in hex, e.g. 0201.'''
+)
+@click.option(
+    '-l', '--dlc',
+    default=8,
+    type=click.INT,
+    help='''Length of the request.'''
+)
+@click.option(
+    '-a', '--answer-id',
+    required=True,
+    callback=_int,
+    help='''The id of the response frame.'''
+)
+@click.option(
+    '-t', '--timeout',
+    default=1.0,
+    type=click.FLOAT,
+    help='''Time to wait for the response [s].'''
+)
+def request(**kwargs):
+    '''
+    Sends the frame and waits for the response.
+
+    Example:
+    pelican request -i 0x7DF -d 0201 -a 0x7E8
+    '''
+    board = pelican.Pelican(_board)
+    message = {
+        'id': kwargs['id'],
+        'ext': kwargs['ext'],
+        'data': kwargs['data'],
+        'dlc': kwargs['dlc'],
+        'rtr': False,
+    }
+    frame = board.request(message, kwargs['answer_id'], CONFIG_FILE,
+                          kwargs['timeout'])
+    print(frame)
+
+
+@cli.command()
+@click.option(
+    '-t', '--tx-id',
+    required=True,
+    callback=_int,
+    help='''The id of the frames sent to the node.'''
+)
+@click.option(
+    '-r', '--rx-id',
+    required=True,
+    callback=_int,
+    help='''The id of the frames sent by the node.'''
+)
+@click.option(
+    '-x', '--ext',
+    default=False,
+    type=click.BOOL,
+    help='''Whether the ids are extended.'''
+)
+@click.option(
+    '-d', '--data',
+    required=True,
+    callback=_hex,
+    help='''Data of the request in hex, e.g. 22F190.'''
+)
+@click.option(
+    '--timeout',
+    default=1.0,
+    type=click.FLOAT,
+    help='''Time to wait for the response [s].'''
+)
+def isotp(**kwargs):
+    '''
+    Sends the data via ISO-TP and prints the response.
+
+    Example:
+    pelican isotp -t 0x7E0 -r 0x7E8 -d 22F190
+    '''
+    board = pelican.Pelican(_board)
+    data = board.isotp_request(kwargs['data'], kwargs['tx_id'],
+                               kwargs['rx_id'], CONFIG_FILE,
+                               kwargs['timeout'], kwargs['ext'])
+    print(None if data is None else data.hex())
+
+
+@cli.command()
+@click.option(
+    '-w', '--window',
+    default=0.5,
+    type=click.FLOAT,
+    help='''Time to listen to every candidate speed [s].'''
+)
+@click.option(
+    '--save',
+    is_flag=True,
+    default=False,
+    help='''Store the detected speed in the configuration.'''
+)
+def autobaud(**kwargs):
+    '''
+    Detects the speed of the bus.
+
+    Example:
+    pelican autobaud --save
+    '''
+    board = pelican.Pelican(_board)
+    speed = board.autobaud(CONFIG_FILE, kwargs['window'])
+    if speed is None:
+        print('No valid frames at any supported speed.')
+        return
+    print(f'Detected speed {speed}Kb/s')
+
+    if kwargs['save']:
+        path = os.path.join(os.path.dirname(__file__), CONFIG_FILE)
+        with open(path, 'r') as conf:
+            config = yaml.load(conf, Loader=yaml.FullLoader)
+        config['speed'] = speed
+        with open(path, 'w') as conf:
+            conf.write(yaml.dump(config))
+
+
+@cli.command('capture')
+@click.option(
+    '-i', '--id',
+    default=None,
+    callback=_int,
+    help='''Trigger on the frame with this id.'''
+)
+@click.option(
+    '-x', '--ext',
+    default=None,
+    type=click.BOOL,
+    help='''Whether the trigger frame is extended, any if not set.'''
+)
+@click.option(
+    '-m', '--mask',
+    default=None,
+    help='''Trigger on the data bytes selected by the hex mask...'''
+)
+@click.option(
+    '-v', '--value',
+    default=None,
+    help='''...being equal to these hex bytes.'''
+)
+@click.option(
+    '-e', '--error',
+    is_flag=True,
+    default=False,
+    help='''Trigger on CAN error flags.'''
+)
+@click.option(
+    '--pre',
+    default=192,
+    type=click.INT,
+    help='''Amount of frames kept before the trigger.'''
+)
+@click.option(
+    '--post',
+    default=64,
+    type=click.INT,
+    help='''Amount of frames kept after the trigger.'''
+)
+@click.option(
+    '-t', '--timeout',
+    default=60.0,
+    type=click.FLOAT,
+    help='''Time to wait for the trigger [s].'''
+)
+@click.option(
+    '--post-timeout',
+    default=1.0,
+    type=click.FLOAT,
+    help='''Time to wait for the frames after the trigger [s].'''
+)
+@click.option(
+    '-o', '--output',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='''Capture file to append the frames to.'''
+)
+def capture_frames(**kwargs):
+    '''
+    Captures the frames around the trigger.
+
+    Example:
+    pelican capture -i 0x123 -m ff00 -v 0100 --pre 100 -o fault.plcn
+    '''
+    trigger = {}
+    if kwargs['id'] is not None:
+        trigger['id'] = kwargs['id']
+    if kwargs['ext'] is not None:
+        trigger['ext'] = kwargs['ext']
+    if kwargs['mask'] is not None:
+        trigger['mask'] = _hex(None, None, kwargs['mask'])
+        trigger['value'] = _hex(None, None, kwargs['value'] or '')
+        trigger['value'] += bytes(len(trigger['mask']) -
+                                  len(trigger['value']))
+    if kwargs['error']:
+        trigger['error'] = True
+    if not trigger:
+        raise click.UsageError('Set the trigger: --id, --mask or --error.')
+
+    board = pelican.Pelican(_board)
+    frames = board.capture(CONFIG_FILE, trigger, kwargs['pre'],
+                           kwargs['post'], kwargs['timeout'],
+                           kwargs['post_timeout'])
+    if frames is None:
+        print('Not triggered.')
+        return
+
+    if kwargs['output']:
+        capture.write(kwargs['output'], frames)
+        print(f"{len(frames)} frames written to {kwargs['output']}")
+    else:
+        for frame in frames:
+            print(frame)
+
+
+@cli.command()
+@click.option(
+    '-d', '--duration',
+    default=0,
+    type=click.FLOAT,
+    help='''Time to monitor [s], 0 means until interrupted.'''
+)
+@click.option(
+    '-c', '--changes',
+    is_flag=True,
+    default=False,
+    help='''Forward only the frames with changed payload.'''
+)
+@click.option(
+    '-L', '--limit',
+    multiple=True,
+    callback=_limits,
+    help='''Forward the id at most N times per second, as ID:N.'''
+)
+@click.option(
+    '-s', '--summary',
+    default=1.0,
+    type=click.FLOAT,
+    help='''Period of the suppressed frames summary [s].'''
+)
+@click.option(
+    '-o', '--output',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='''Capture file to append the frames to.'''
+)
+def monitor(**kwargs):
+    '''
+    Prints the received frames.
+
+    Example:
+    pelican monitor --changes --limit 0x123:10 -o bus.plcn
+    '''
+    frames = []
+
+    def on_frame(frame):
+        if not kwargs['output']:
+            print(frame)
+            return
+        frames.append(frame)
+        if len(frames) >= 1000:
+            capture.write(kwargs['output'], frames)
+            frames.clear()
+
+    def on_summary(suppressed):
+        if kwargs['output'] and frames:
+            capture.write(kwargs['output'], frames)
+            frames.clear()
+        if suppressed:
+            print('suppressed:', ', '.join(
+                f'{hex(can_id)}: {n}' for (can_id, _), n in
+                sorted(suppressed.items())))
+
+    board = pelican.Pelican(_board)
+    try:
+        board.monitor(CONFIG_FILE, on_frame, on_summary, kwargs['duration'],
+                      kwargs['changes'], kwargs['limit'], kwargs['summary'])
+    finally:
+        if kwargs['output'] and frames:
+            capture.write(kwargs['output'], frames)
+
+
+@cli.command()
+@click.option(
+    '-n', '--count',
+    default=1000,
+    type=click.INT,
+    help='''Amount of frames to send.'''
+)
+@click.option(
+    '-R', '--rate',
+    default=0,
+    type=click.INT,
+    help='''Target rate [frames/s], 0 sends as fast as possible.'''
+)
+@click.option(
+    '-i', '--id',
+    'ids',
+    multiple=True,
+    default=['0x100'],
+    callback=_ints,
+    help='''Id of the frames, repeat to cycle through several ids.'''
+)
+@click.option(
+    '-l', '--dlc',
+    'dlcs',
+    multiple=True,
+    default=[8],
+    type=click.INT,
+    help='''Length of the frames, repeat to cycle through several.'''
+)
+def stress(**kwargs):
+    '''
+    Measures the board performance in loopback mode.
+
+    Example:
+    pelican stress -n 5000 -i 0x100 -i 0x18ff50e5 -l 2 -l 8
+    '''
+    board = pelican.Pelican(_board)
+    res = board.stress(CONFIG_FILE, kwargs['count'], kwargs['rate'],
+                       kwargs['ids'], kwargs['dlcs'])
+    print(f"sent: {res['sent']}, received: {res['received']}, "
+          f"lost: {res['lost']}, reordered: {res['reordered']}")
+    print(f"sustained: {res['fps']} frames/s")
+    print(f"latency [us]: p50 {res['p50']}, p90 {res['p90']}, "
+          f"p99 {res['p99']}, max {res['p100']}")
+
+
+@cli.command()
+@click.option(
+    '-s', '--size',
+    default=4096,
+    type=click.INT,
+    help='''Amount of bytes written to the board.'''
+)
+@click.option(
+    '-n', '--frames',
+    default=1000,
+    type=click.INT,
+    help='''Amount of frames read from the board.'''
+)
+def linktest(**kwargs):
+    '''
+    Measures the throughput of the serial link.
+
+    Example:
+    pelican -r 921600 linktest
+    '''
+    board = pelican.Pelican(_board)
+    res = board.linktest(kwargs['size'], kwargs['frames'])
+    print(f"baudrate: {res['baudrate']}")
+    print(f"write chunk: {res['chunk']} B")
+    print(f"host to board: {res['tx_bytes_per_sec']:.0f} B/s")
+    print(f"board to host: {res['rx_bytes_per_sec']:.0f} B/s")
+    print(f"board to host: {res['frames_per_sec']:.0f} frames/s")
+
+
+@cli.command()
+@click.argument(
+    'files',
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    '-i', '--id',
+    'ids',
+    multiple=True,
+    callback=_ints,
+    help='''Id of the frames, repeat to match any of several ids.'''
+)
+@click.option(
+    '-x', '--ext',
+    default=None,
+    type=click.BOOL,
+    help='''Whether the frames are extended.'''
+)
+@click.option(
+    '-r', '--rtr',
+    default=None,
+    type=click.BOOL,
+    help='''Whether the frames are remote.'''
+)
+@click.option(
+    '-l', '--dlc',
+    default=None,
+    type=click.INT,
+    help='''Length of the frames.'''
+)
+@click.option(
+    '-d', '--data',
+    default=None,
+    help='''Leading data bytes of the frames in hex.'''
+)
+@click.option(
+    '-m', '--mask',
+    default=None,
+    help='''Hex mask of the data bytes to compare.'''
+)
+@click.option(
+    '--start',
+    default=None,
+    type=click.FLOAT,
+    help='''Earliest host time of the frames [s since epoch].'''
+)
+@click.option(
+    '--end',
+    default=None,
+    type=click.FLOAT,
+    help='''Host time the frames are before [s since epoch].'''
+)
+@click.option(
+    '-j', '--jobs',
+    default=None,
+    type=click.INT,
+    help='''Amount of worker processes, all cores by default.'''
+)
+@click.option(
+    '-n', '--limit',
+    default=0,
+    type=click.INT,
+    help='''Amount of the matching frames to print.'''
+)
+def query(**kwargs):
+    '''
+    Searches the capture files.
+
+    Example:
+    pelican query -i 0x7E8 -d 037f bus.plcn
+    '''
+    data = None if kwargs['data'] is None else \
+        _hex(None, None, kwargs['data'])
+    mask = None if kwargs['mask'] is None else \
+        _hex(None, None, kwargs['mask'])
+    predicate = query_engine.Query(kwargs['ids'] or None, kwargs['ext'],
+                                   kwargs['rtr'], kwargs['dlc'], data, mask,
+                                   kwargs['start'], kwargs['end'])
+    res = query_engine.run(kwargs['files'], predicate, kwargs['jobs'],
+                           kwargs['limit'])
+
+    for frame in res['frames']:
+        print(frame)
+    print(f"count: {res['count']}")
+    if res['count']:
+        print(f"first: {res['first']}")
+        print(f"last: {res['last']}")
+    if res['rate'] is not None:
+        print(f"rate: {res['rate']:.3f} frames/s")
+
+
 @cli.command()
 def blink(**kwargs):
     '''
@@ -138,15 +661,30 @@ def blink(**kwargs):
     board.blink()
 
 
+def _close():
+    '''
+    Restores the link rate the board started with and closes the port.
+    '''
+    global _board, _link
+    if _board is None:
+        return
+    try:
+        if _link is not None:
+            _link.restore()
+    except:
+        pass
+    try:
+        _board.close()
+    except:
+        pass
+    _board = _link = None
+
+
 def main():
     try:
         cli()
     finally:
-        if _board is not None:
-            try:
-                _board.close()
-            except:
-                pass
+        _close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
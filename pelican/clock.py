@@ -0,0 +1,138 @@
+# Pelican - Board clock correlation
+# Author: Oleksandr Ivanchuk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from collections import deque
+from typing import Optional
+
+
+TICKS_PERIOD = 1 << 30  # `time.ticks_us()` wraps around at this value
+# on the ESP32 port of micropython.
+
+DRIFT_SPAN = 10.0  # Minimal time span of the pings [s] to estimate the drift,
+# as over shorter spans the serial jitter outweighs the crystal error.
+
+MAX_DRIFT = 500e-6  # Crystals are far better than that, so a bigger estimate
+# is considered as jitter and clamped.
+
+RESYNC_PERIOD = 2.0  # Time between the pings [s] in long sessions, so the
+# drift is estimated once the session is longer than DRIFT_SPAN.
+
+
+def ticks_diff(new: int, old: int) -> int:
+    '''
+    Signed difference between two wrapping board tick values [us].
+
+    Works like `time.ticks_diff` on the board, so the result is only
+    meaningful while the ticks are less than half a period apart.
+    '''
+    half = TICKS_PERIOD // 2
+    return ((new - old + half) % TICKS_PERIOD) - half
+
+
+class ClockSync():
+    '''
+    Estimates offset and drift of the board clock against the host clock.
+
+    Each sample is a ping exchange: host time before the request, board
+    ticks read while handling it and host time after the reply arrived.
+
+    The board ticks keep running over the soft reboots of the raw REPL, so
+    one instance collects the pings of all the sessions with the board.
+    '''
+    def __init__(self, max_samples: int = 64) -> None:
+        '''
+        Keep up to `max_samples` most recent ping exchanges.
+        '''
+        # (host midpoint [s], round trip [s], unwrapped board ticks [us])
+        self._samples: deque = deque(maxlen=max_samples)
+        self.drift = 0.0  # board clock rate error, e.g. 20e-6 is 20 ppm fast
+        self._anchor: Optional[tuple] = None
+
+
+    def add(self, host_send: float, ticks: int, host_recv: float) -> None:
+        '''
+        Register a ping exchange and refresh the estimation.
+        '''
+        host_mid = (host_send + host_recv) / 2
+        if self._samples:
+            last_host, _, last_board = self._samples[-1]
+            # The host clock tells how many periods passed since the last
+            # ping, so gaps longer than half a period are unwrapped too.
+            expected = last_board + (host_mid - last_host) * 1e6
+            periods = round((expected - ticks) / TICKS_PERIOD)
+            board = ticks + periods * TICKS_PERIOD
+        else:
+            board = ticks
+        self._samples.append((host_mid, host_recv - host_send, board))
+        self._fit()
+
+
+    def due(self, now: float) -> bool:
+        '''
+        Whether a long session should ping the board again at host time
+        `now` [s].
+        '''
+        return (not self._samples or
+                now - self._samples[-1][0] >= RESYNC_PERIOD)
+
+
+    def _fit(self) -> None:
+        '''
+        Least squares drift estimation anchored on the fastest ping.
+        '''
+        # The pings delayed by other traffic on the link would outweigh
+        # the crystal error, only the fast ones are fitted.
+        fastest = min(s[1] for s in self._samples)
+        samples = [s for s in self._samples if s[1] <= 2 * fastest + 1e-3]
+        span = samples[-1][0] - samples[0][0]
+        if span >= DRIFT_SPAN:
+            n = len(samples)
+            mean_h = sum(s[0] for s in samples) / n
+            mean_b = sum(s[2] for s in samples) / n
+            var = sum((s[0] - mean_h) ** 2 for s in samples)
+            cov = sum((s[0] - mean_h) * (s[2] - mean_b) for s in samples)
+            drift = cov / var / 1e6 - 1
+            self.drift = max(-MAX_DRIFT, min(MAX_DRIFT, drift))
+
+        # The shortest round trip bounds the offset error the best.
+        host, _, board = min(self._samples, key=lambda s: s[1])
+        self._anchor = (host, board)
+
+
+    def to_host(self, ticks: int, near: Optional[float] = None) -> float:
+        '''
+        Converts board ticks [us] to host wall-clock time [s].
+
+        The ticks are unwrapped against the latest ping, so frames must be
+        received within half a tick period of a clock synchronization,
+        unless `near` tells the approximate host time of the frame, e.g.
+        the time it arrived at.
+        '''
+        if self._anchor is None:
+            raise ValueError('Clock is not synchronized with the board.')
+        host, anchor = self._anchor
+        if near is None:
+            latest = self._samples[-1][2]
+        else:
+            latest = anchor + (near - host) * 1e6 * (1 + self.drift)
+        board = latest + ticks_diff(ticks, round(latest) % TICKS_PERIOD)
+        return host + (board - anchor) / (1e6 * (1 + self.drift))
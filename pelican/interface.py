@@ -0,0 +1,360 @@
+# Pelican - python-can interface
+# Author: Oleksandr Ivanchuk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+try:
+    import can
+except Exception as e:
+    raise Exception(f'Cannot import python-can {e}')
+
+from ampy import pyboard
+
+from pelican import capture
+from pelican.pelican import Pelican
+from pelican.waiters import Waiters
+
+
+log = logging.getLogger('pelican.interface')
+
+QUEUE_SIZE = 10000  # Frames kept for `recv` before the oldest are dropped.
+
+
+def _registers(can_id: int, ext: bool, mask: bool = False) -> bytes:
+    '''
+    Encodes the id to SIDH, SIDL, EID8, EID0 filter or mask registers.
+    '''
+    if ext:
+        sidl = ((can_id >> 13) & 0xE0) | ((can_id >> 16) & 0x03)
+        if not mask:
+            sidl |= 0x08  # EXIDE, the filter matches extended frames only
+        return bytes([(can_id >> 21) & 0xFF, sidl, (can_id >> 8) & 0xFF,
+                      can_id & 0xFF])
+    return bytes([(can_id >> 3) & 0xFF, (can_id << 5) & 0xE0, 0, 0])
+
+
+def hardware_filter(can_filters) -> tuple:
+    '''
+    Converts python-can filters to the MCP2515 filter registers as used by
+    `CAN.start`: two filters (F0, F1) sharing one mask (M0).
+
+    Returns (filter, exact): filter is None to receive everything, exact
+    tells whether the hardware matches exactly the given filters, otherwise
+    it lets through a superset which is filtered on the host.
+    '''
+    if not can_filters:
+        return None, True
+    exts = {bool(f.get('extended')) for f in can_filters}
+    if len(exts) > 1 or any('extended' not in f for f in can_filters):
+        # The mask cannot serve both frame formats.
+        return None, False
+    ext = exts.pop()
+    width = 0x1FFFFFFF if ext else 0x7FF
+
+    masks = {f['can_mask'] & width for f in can_filters}
+    if len(can_filters) <= 2 and len(masks) == 1:
+        mask = masks.pop()
+        ids = [f['can_id'] & mask for f in can_filters]
+        exact = True
+    else:
+        # Keep only the bits all the filters care about and agree on.
+        mask = width
+        for f in can_filters:
+            mask &= f['can_mask']
+        for f in can_filters[1:]:
+            mask &= ~(f['can_id'] ^ can_filters[0]['can_id'])
+        ids = [can_filters[0]['can_id'] & mask]
+        exact = False
+
+    return {'F0': _registers(ids[0], ext),
+            'F1': _registers(ids[-1], ext),
+            'M0': _registers(mask, ext, mask=True)}, exact
+
+
+class PelicanBus(can.BusABC):
+    '''
+    python-can interface to the micropython board with MCP2515.
+
+    The board runs a persistent session (`CAN.serve`), a reader thread
+    collects the batches of frames into a bounded queue, so `recv` does not
+    wait for the REPL.
+
+    Once the session ends, e.g. on an exception on the board, `recv` and
+    `send` raise `can.CanOperationError`.
+
+    Example:
+    bus = can.Bus(interface='pelican', channel='/dev/ttyUSB0', bitrate=500000)
+    '''
+    def __init__(self, channel, can_filters=None, bitrate: int = 500000,
+                 crystal: int = 8, cs: int = 27, baudrate: int = 115200,
+                 listen_only: bool = False, queue_size: int = QUEUE_SIZE,
+                 batch: int = 16, batch_ms: int = 5, **kwargs) -> None:
+        '''
+        channel: serial port of the board
+        bitrate: CAN bitrate [b/s], see `CAN.start` for the supported ones
+        crystal: MCP2515 crystal oscillator [MHz]
+        cs: CS pin of MCP2515
+        baudrate: serial port baudrate
+        queue_size: frames kept for `recv` before the oldest are dropped
+        batch, batch_ms: frames the board collects before sending them to
+                         the host, and the longest it holds a frame [ms]
+        '''
+        self.channel_info = f'peliCAN on {channel}'
+        self._pyboard = pyboard.Pyboard(channel, baudrate=baudrate)
+        self._pelican = Pelican(self._pyboard)
+        self._settings = (cs, bitrate // 1000, crystal, listen_only)
+        self._batch = (batch, batch_ms)
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._write_lock = threading.Lock()
+        self._running = threading.Event()
+        self._reader: Optional[threading.Thread] = None
+        self._hw_filter = None
+        self._filtered = True
+        self._error: Optional[str] = None
+        self._ping: Optional[float] = None
+        self.dropped = 0
+        self.waiters = Waiters()
+
+        self._pelican._check_onboard_file()
+        super().__init__(channel, can_filters=can_filters, **kwargs)
+        self._start()
+
+
+    def _start(self) -> None:
+        '''
+        Starts the session on the board and the reader thread.
+        '''
+        cs, speed, crystal, listen_only = self._settings
+        self._pyboard.enter_raw_repl()
+        self._pyboard.exec('from mcpcan import CAN')
+        self._pyboard.exec(f'can = CAN(cs={cs})')
+        self._pyboard.exec(
+            f'can.start(speed_cfg={speed}, crystal={crystal}, '
+            f'filter={self._hw_filter}, listen_only={listen_only})')
+        self._pelican._sync_clock()
+        self._pyboard.exec_raw_no_follow('can.serve({0}, {1})'.format(
+            *self._batch))
+
+        self._error = None
+        self._ping = None
+        self._running.set()
+        self._reader = threading.Thread(target=self._read, daemon=True,
+                                        name='pelican-reader')
+        self._reader.start()
+
+
+    def _stop(self) -> None:
+        '''
+        Interrupts the session on the board and stops the reader thread.
+        '''
+        self._running.clear()
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+        with self._write_lock:
+            self._pyboard.serial.write(b'\x03')
+        # Let the board report the interruption, then drop it.
+        time.sleep(0.1)
+        self._pyboard.serial.reset_input_buffer()
+        self._pyboard.exit_raw_repl()
+
+
+    def _read(self) -> None:
+        '''
+        Reader thread: parses the batches of frames from the board and
+        pings its clock every `clock.RESYNC_PERIOD`.
+        '''
+        serial = self._pyboard.serial
+        serial.timeout = 0.1
+        line = b''
+        try:
+            while self._running.is_set():
+                line += serial.readline()
+                if b'\x04' in line:
+                    # The raw REPL ends the execution with EOT and the
+                    # error output, the session is over.
+                    if line.count(b'\x04') < 2:
+                        serial.timeout = 1.0
+                        line += serial.read_until(b'\x04')
+                    error = line.split(b'\x04')[1].decode(errors='replace')
+                    self._fail(error.strip() or 'session ended')
+                    return
+                if line.endswith(b'\n'):
+                    self._parse(line.decode(errors='replace').strip())
+                    line = b''
+                self._resync()
+        except Exception as e:
+            self._fail(str(e))
+
+
+    def _parse(self, text: str) -> None:
+        '''
+        Handles one line from the board.
+        '''
+        if text.startswith('R'):
+            try:
+                window = bytes.fromhex(text[1:])
+            except ValueError:
+                log.warning('Dropped corrupted line: %r', text)
+                return
+            self._put_batch(window)
+        elif text.startswith('P ') and self._ping is not None:
+            try:
+                self._pelican.clock.add(self._ping, int(text[2:]),
+                                        time.time())
+            except ValueError:
+                log.warning('Dropped corrupted line: %r', text)
+            self._ping = None
+        elif text.startswith('E'):
+            log.warning('Board: %s', text[1:].strip())
+
+
+    def _resync(self) -> None:
+        '''
+        Pings the board clock in band, so the drift is estimated during
+        the session.
+        '''
+        now = time.time()
+        if self._ping is not None and now - self._ping > 1.0:
+            self._ping = None  # The reply got lost.
+        if self._ping is None and self._pelican.clock.due(now):
+            self._ping = now
+            with self._write_lock:
+                self._pyboard.serial.write(b'P\n')
+
+
+    def _fail(self, error: str) -> None:
+        '''
+        Marks the bus failed, `recv` and `send` raise from now on.
+        '''
+        log.error('Board session ended: %s', error)
+        self._error = error
+        # Wake up the waiting `recv`.
+        self._put(None)
+
+
+    def _put(self, msg) -> None:
+        '''
+        Queues the message, dropping the oldest one if the queue is full,
+        as the latest messages are the most useful.
+        '''
+        while True:
+            try:
+                self._queue.put_nowait(msg)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass  # Taken by `recv` meanwhile.
+
+
+    def _put_batch(self, window: bytes) -> None:
+        '''
+        Converts the raw frames to messages and queues them.
+        '''
+        now = time.time()
+        for frame in capture.split(window):
+            frame['host_tm'] = self._pelican.clock.to_host(frame['tm'], now)
+            self.waiters.dispatch(frame)
+            self._put(can.Message(timestamp=frame['host_tm'],
+                                  arbitration_id=frame['id'],
+                                  is_extended_id=frame['ext'],
+                                  is_remote_frame=frame['rtr'],
+                                  dlc=frame['dlc'],
+                                  data=frame['data'][:frame['dlc']],
+                                  channel=self.channel_info,
+                                  is_rx=True))
+
+
+    def _apply_filters(self, filters) -> None:
+        '''
+        Programs the MCP2515 filters, restarting the board session if it is
+        running.
+        '''
+        self._hw_filter, self._filtered = hardware_filter(filters)
+        if self._reader is not None:
+            self._stop()
+            self._start()
+
+
+    def _recv_internal(self, timeout: Optional[float]) -> tuple:
+        if self._error is not None and self._queue.empty():
+            raise can.CanOperationError(self._error)
+        try:
+            msg = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None, self._filtered
+        if msg is None:
+            self._put(None)  # Keep failing for the next calls.
+            raise can.CanOperationError(self._error or 'session ended')
+        return msg, self._filtered
+
+
+    def send(self, msg: can.Message, timeout: Optional[float] = None) -> None:
+        '''
+        Queues the message on the board, which sends it as soon as its
+        transmit buffer is free.
+        '''
+        if self._error is not None:
+            raise can.CanOperationError(self._error)
+        flags = ((0x01 if msg.is_extended_id else 0) |
+                 (0x02 if msg.is_remote_frame else 0))
+        payload = (msg.arbitration_id.to_bytes(4, 'big') +
+                   bytes([flags, msg.dlc]) + bytes(msg.data))
+        with self._write_lock:
+            self._pyboard.serial.write(b'T' + payload.hex().encode() + b'\n')
+
+
+    def request(self, msg: can.Message, response_id: int,
+                timeout: float = 1.0) -> Optional[can.Message]:
+        '''
+        Sends the message and waits for the frame with `response_id`.
+        Any amount of requests may wait at once, each response is matched
+        by its id in O(1).
+        '''
+        waiter = self.waiters.register(response_id)
+        self.send(msg)
+        frame = waiter.wait(timeout)
+        if frame is None:
+            self.waiters.cancel(waiter)
+            return None
+        return can.Message(timestamp=frame['host_tm'],
+                           arbitration_id=frame['id'],
+                           is_extended_id=frame['ext'],
+                           is_remote_frame=frame['rtr'],
+                           dlc=frame['dlc'],
+                           data=frame['data'][:frame['dlc']],
+                           channel=self.channel_info,
+                           is_rx=True)
+
+
+    def shutdown(self) -> None:
+        super().shutdown()
+        if self._reader is not None:
+            self._stop()
+        self._pyboard.close()
@@ -0,0 +1,217 @@
+# Pelican - Serial link tuning
+# Author: Oleksandr Ivanchuk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import time
+
+from ampy.pyboard import PyboardError
+
+from pelican.capture import FRAME_SIZE
+
+
+RATES = (921600, 460800, 230400)  # Candidate UART rates, fastest first.
+
+MIN_CHUNK = 32  # Chunk size limits [B] of the writes to the board.
+MAX_CHUNK = 2048
+
+REVERT_MS = 1000  # The board falls back to the previous rate if the host
+# does not confirm the new one within this time.
+
+
+class Link():
+    '''
+    Tunes the serial link to the board: UART rate and write chunk size.
+    '''
+    def __init__(self, pyboard, chunk: int = MIN_CHUNK,
+                 clock=time.monotonic) -> None:
+        '''
+        chunk: initial size of the writes to the board
+        clock: source of time for the measurements
+        '''
+        self._pyboard = pyboard
+        self.chunk = chunk
+        self._clock = clock
+        self._original = None
+        self._uart = 0
+
+
+    def _confirm(self, timeout: float) -> bool:
+        '''
+        Cancels the fallback timer on the board, which is only possible if
+        both sides use the same rate.
+        '''
+        serial = self._pyboard.serial
+        serial.reset_input_buffer()
+        # Written by hand as the prompt of the raw REPL was sent while the
+        # rates were switching.
+        serial.write(b'_pl_t.deinit()\x04')
+        previous, serial.timeout = serial.timeout, timeout
+        try:
+            if serial.read(2) != b'OK':
+                return False
+            data, _ = self._pyboard.follow(timeout)
+            return data == b''
+        except PyboardError:
+            return False
+        finally:
+            serial.timeout = previous
+
+
+    def negotiate(self, rates=RATES, uart: int = 0,
+                  timeout: float = 1.0) -> int:
+        '''
+        Switches the board REPL UART and the host port to the fastest of
+        `rates` both can keep up with and returns the rate in use.
+
+        Every attempt is guarded by a timer on the board which restores the
+        previous rate unless the host confirms the new one, so a rate the
+        USB to serial bridge cannot handle leaves the link usable.
+        '''
+        serial = self._pyboard.serial
+        original = serial.baudrate
+        self._uart = uart
+        for rate in rates:
+            if rate <= original:
+                break
+            self._pyboard.enter_raw_repl()
+            self._pyboard.exec('from machine import UART, Timer')
+            self._pyboard.exec('_pl_t = Timer(0)')
+            self._pyboard.exec_raw_no_follow(
+                '_pl_t.init(mode=Timer.ONE_SHOT, period={0}, '
+                'callback=lambda t: UART({1}, {2})); UART({1}, {3})'.format(
+                    REVERT_MS, uart, original, rate))
+            time.sleep(0.05)
+            serial.baudrate = rate
+            if self._confirm(timeout):
+                try:
+                    # The next session starts with a soft reboot, check the
+                    # board keeps the rate over it.
+                    self._pyboard.exit_raw_repl()
+                    self._pyboard.enter_raw_repl()
+                    self._pyboard.exit_raw_repl()
+                    self._original = original
+                    return rate
+                except PyboardError:
+                    pass
+            # Wait for the board to fall back and resynchronize.
+            serial.baudrate = original
+            time.sleep(REVERT_MS / 1000 + 0.1)
+            serial.reset_input_buffer()
+            self._pyboard.enter_raw_repl()
+            self._pyboard.exit_raw_repl()
+        return original
+
+
+    def restore(self) -> None:
+        '''
+        Switches back to the rate used before the negotiation, so the next
+        connection finds the board at the rate it expects.
+        '''
+        if self._original is None:
+            return
+        self._pyboard.enter_raw_repl()
+        self._pyboard.exec_raw_no_follow(
+            'from machine import UART; UART({0}, {1})'.format(
+                self._uart, self._original))
+        time.sleep(0.05)
+        self._pyboard.serial.baudrate = self._original
+        self._pyboard.exit_raw_repl()
+        self._original = None
+
+
+    def put(self, filename: str, data: bytes) -> None:
+        '''
+        Writes the file to the board in chunks of adaptive size.
+        '''
+        self._pyboard.enter_raw_repl()
+        try:
+            self._pyboard.exec("f = open('{0}', 'wb')".format(filename))
+            self._write(filename, data)
+            self._pyboard.exec('f.close()')
+        finally:
+            self._pyboard.exit_raw_repl()
+
+
+    def _write(self, filename: str, data: bytes) -> None:
+        '''
+        Writes the data to the file `f` open on the board in raw REPL.
+
+        A chunk is acknowledged by the amount of bytes the board has written.
+        Acknowledged chunks double the size up to MAX_CHUNK, while an error
+        or a wrong acknowledgement halves it and the rest is sent again
+        from the last acknowledged position.
+        '''
+        i = 0
+        while i < len(data):
+            chunk = data[i:i + self.chunk]
+            try:
+                ack = self._pyboard.exec('print(f.write({0!r}))'.format(chunk))
+                ok = int(ack) == len(chunk)
+            except (PyboardError, ValueError):
+                ok = False
+            if ok:
+                i += len(chunk)
+                self.chunk = min(MAX_CHUNK, self.chunk * 2)
+                continue
+            if self.chunk == MIN_CHUNK:
+                raise PyboardError('Cannot write {0} to the board.'.format(
+                    filename))
+            self.chunk = max(MIN_CHUNK, self.chunk // 2)
+            # Drop whatever part of the chunk has been written.
+            self._pyboard.exec('f.seek({0})'.format(i))
+
+
+    def test(self, size: int = 4096, frames: int = 1000) -> dict:
+        '''
+        Measures the throughput of the link in both directions.
+
+        size: amount of bytes written to the board
+        frames: amount of frames read from the board
+        '''
+        # Entering the raw REPL soft reboots the board, which is not part of
+        # the link throughput.
+        self._pyboard.enter_raw_repl()
+        try:
+            self._pyboard.exec("f = open('_linktest', 'wb')")
+            start = self._clock()
+            self._write('_linktest', bytes(size))
+            tx_time = self._clock() - start
+            self._pyboard.exec('f.close()')
+
+            self._pyboard.exec('import os, ubinascii')
+            self._pyboard.exec("os.remove('_linktest')")
+            self._pyboard.exec(
+                'h = ubinascii.hexlify(bytes({0})).decode()'.format(
+                    FRAME_SIZE))
+            start = self._clock()
+            data = self._pyboard.exec(
+                'for i in range({0}): print(h)'.format(frames))
+            rx_time = self._clock() - start
+        finally:
+            self._pyboard.exit_raw_repl()
+
+        return {
+            'baudrate': self._pyboard.serial.baudrate,
+            'chunk': self.chunk,
+            'tx_bytes_per_sec': size / tx_time,
+            'rx_bytes_per_sec': len(data) / rx_time,
+            'frames_per_sec': frames / rx_time,
+        }
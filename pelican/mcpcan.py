@@ -20,9 +20,78 @@
 # SOFTWARE.
 
 import time
+from array import array
 from machine import Pin, SPI
 
 
+# BEGIN BIT TIMING TABLE
+# Bit timing registers CNF3, CNF2, CNF1 by crystal [MHz] and
+# speed [Kb/s]. Generated by `python -m pelican.bittiming`.
+CNF = {
+    8: {
+        5: b'\x01\xb5\x31',
+        10: b'\x01\xb5\x18',
+        20: b'\x02\xbf\x09',
+        33: b'\x01\xad\x07',
+        40: b'\x02\xbf\x04',
+        50: b'\x01\xb5\x04',
+        80: b'\x01\x9a\x04',
+        95: b'\x01\xac\x02',
+        100: b'\x02\xbf\x01',
+        125: b'\x01\xb5\x01',
+        200: b'\x02\xbf\x00',
+        250: b'\x01\xb5\x00',
+        500: b'\x01\x91\x00',
+    },
+    16: {
+        5: b'\x07\xbf\x3f',
+        10: b'\x01\xb5\x31',
+        20: b'\x01\xb5\x18',
+        33: b'\x01\xb5\x0e',
+        40: b'\x02\xbf\x09',
+        50: b'\x01\xb5\x09',
+        80: b'\x02\xbf\x04',
+        95: b'\x01\xac\x05',
+        100: b'\x01\xb5\x04',
+        125: b'\x01\xb5\x03',
+        200: b'\x02\xbf\x01',
+        250: b'\x01\xb5\x01',
+        500: b'\x01\xb5\x00',
+        1000: b'\x01\x91\x00',
+    },
+    20: {
+        10: b'\x02\xbf\x31',
+        20: b'\x02\xbf\x18',
+        33: b'\x01\xad\x13',
+        40: b'\x01\x9a\x18',
+        50: b'\x02\xbf\x09',
+        80: b'\x07\xbf\x04',
+        95: b'\x01\xad\x06',
+        100: b'\x02\xbf\x04',
+        125: b'\x01\xb5\x04',
+        200: b'\x01\x9a\x04',
+        250: b'\x02\xbf\x01',
+        500: b'\x02\xbf\x00',
+        1000: b'\x01\x9a\x00',
+    },
+}
+# END BIT TIMING TABLE
+
+FRAME_SIZE = 17  # Raw Rx buffer (13 bytes) with timestamp (4 bytes).
+
+RX_KEEP = 32  # Messages with other ids `recv_id` keeps for `recv_msg`.
+
+
+def _raw_id(dat) -> int:
+    '''
+    Id of the raw Rx buffer, without decoding the whole message.
+    '''
+    if dat[1] & 0x08:
+        return ((dat[0] << 21) | ((dat[1] & 0xE0) << 13) |
+                ((dat[1] & 0x03) << 16) | (dat[2] << 8) | dat[3])
+    return (dat[0] << 3) | (dat[1] >> 5)
+
+
 class CAN:
     '''
     Implements the standard CAN communication protocol.
@@ -66,7 +135,8 @@ class CAN:
               speed_cfg: int = 500,
               crystal: int = 8,
               filter=None,
-              listen_only: bool = False) -> None:
+              listen_only: bool = False,
+              loopback: bool = False) -> None:
         '''
         Starts MCP2515
 
@@ -75,15 +145,20 @@ class CAN:
             - for 16MHz Crystal Oscillator
         5, 10, 20, 33, 40, 50, 80, 95, 100, 125, 200, 250, 500, 1000
             - for 8MHz Crystal Oscillator
-        5, 10, 20, 40, 50, 80, 100, 125, 200, 250, 500
+        5, 10, 20, 33, 40, 50, 80, 95, 100, 125, 200, 250, 500
+            - for 20MHz Crystal Oscillator
+        10, 20, 33, 40, 50, 80, 95, 100, 125, 200, 250, 500, 1000
 
         crystal: defines the frequency of the Crystal Oscillator
-                 could be either 8 or 16 MHz
+                 could be 8, 16 or 20 MHz
 
         filter: filter mode for received packets
         TODO
 
         listen_only: whether to specify the listening mode
+
+        loopback: whether to receive own messages without sending them
+                  to the bus, for self tests
         '''
         # Set to configuration mode
         self._spi_reset()
@@ -109,65 +184,64 @@ class CAN:
         self._spi_write_reg(b'\x18', b'\xff\xff\xff\xff')
         self._spi_write_reg(b'\x24', b'\xff\xff\xff\xff')
 
-        # Set to normal mode or listening mode
-        mode = b'\x60' if listen_only else b'\x00'
+        # Set to normal, listening or loopback mode
+        if loopback:
+            mode = b'\x40'
+        elif listen_only:
+            mode = b'\x60'
+        else:
+            mode = b'\x00'
         self._spi_write_bit(b'\x0f', b'\xe0', mode)
 
 
+    def autobaud(self,
+                 crystal: int = 8,
+                 speeds: list = None,
+                 window_ms: int = 500,
+                 min_frames: int = 2) -> int:
+        '''
+        Detects the communication speed of the bus in Kb/s.
+
+        Every candidate speed (all supported for the crystal by default,
+        fastest first) is listened to for `window_ms` in listen only mode,
+        so the bus is not disturbed. The first speed with at least
+        `min_frames` valid frames and no error flags wins, otherwise None is
+        returned. The CAN stays started at the detected speed.
+        '''
+        if speeds is None:
+            speeds = sorted(CNF.get(crystal, ()), reverse=True)
+        for speed in speeds:
+            self.start(speed_cfg=speed, crystal=crystal, listen_only=True)
+            self._rx_buf = []
+            frames = 0
+            start = time.ticks_ms()
+            while time.ticks_diff(time.ticks_ms(), start) < window_ms:
+                self.check_rx()
+                frames += len(self._rx_buf)
+                self._rx_buf = []
+                # MERRF in CANINTF or error flags in EFLG mean wrong speed.
+                if (self._spi_read_reg(b'\x2c')[0] & 0x80 or
+                        self._spi_read_reg(b'\x2d')[0] & 0x3F):
+                    frames = 0
+                    break
+            if frames >= min_frames:
+                return speed
+        return None
+
+
     def _set_speed(self,
                    speed_cfg: int,
                    crystal: int) -> None:
         '''
         Sets communication rate according to used oscillator.
         '''
-        speed_cfg_at_16M = {
-            1000: b'\x82\xD0\x00',
-            500: b'\x86\xF0\x00',
-            250: b'\x85\xF1\x41',
-            200: b'\x87\xFA\x01',
-            125: b'\x86\xF0\x03',
-            100: b'\x87\xFA\x03',
-            95: b'\x07\xAD\x03',
-            80: b'\x87\xFF\x03',
-            50: b'\x87\xFA\x07',
-            40: b'\x87\xFF\x07',
-            33: b'\x07\xBE\x09',
-            20: b'\x87\xFF\x0F',
-            10: b'\x87\xFF\x1F',
-            5: b'\x87\xFF\x3F'
-        }
-
-        speed_cfg_at_8M = {
-            500: b'\x01\x91\x00',
-            250: b'\x03\xac\x00',
-            200: b'\x04\xb6\x00',
-            125: b'\x03\xac\x01',
-            100: b'\x04\xb6\x01',
-            80: b'\x02\x92\x04',
-            50: b'\x04\xb6\x03',
-            40: b'\x04\xb6\x04',
-            20: b'\x04\xb6\x09',
-            10: b'\x04\xb6\x13',
-            5: b'\x04\xb6\x27'
-        }
-
-        speed = {
-            8: speed_cfg_at_8M,
-            16: speed_cfg_at_16M
-        }
-        if crystal in speed.keys():
-            if speed_cfg in speed[crystal].keys():
-                cfg = speed[crystal].get(speed_cfg, (b'\x00\x00\x00'))
-                print(cfg)
-                self._spi_write_reg(b'\x28', cfg)
-            else:
-                raise Exception('Unsupported speed ({}Kb/s) or oscillator \
-settings incorrect.'.format(speed_cfg))
-        else:
+        if crystal not in CNF:
             raise Exception('Unsupported Crystal Oscillator frequency. \
-select from {}'.format(''.join(speed.keys())))
-
-        del speed
+select from {}'.format(sorted(CNF)))
+        if speed_cfg not in CNF[crystal]:
+            raise Exception('Unsupported speed ({}Kb/s) or oscillator \
+settings incorrect.'.format(speed_cfg))
+        self._spi_write_reg(b'\x28', CNF[crystal][speed_cfg])
 
 
     def send_msg(self, msg: dict, send_chanel: int = None) -> None:
@@ -226,6 +300,267 @@ select from {}'.format(''.join(speed.keys())))
         self._spi_send_msg(1 << send_chanel)
 
 
+    def stress(self,
+               count: int = 1000,
+               rate: int = 0,
+               ids: tuple = (0x100, ),
+               dlcs: tuple = (8, ),
+               timeout_ms: int = 1000) -> dict:
+        '''
+        Sends `count` messages and receives them back, to be used in
+        loopback mode as a repeatable performance measurement.
+
+        rate: target rate in frames/s, 0 sends as fast as possible
+        ids, dlcs: cycled through for the consecutive messages, the ids
+                   above 0x7FF are sent as extended frames
+        timeout_ms: time to wait for the messages still on the way
+
+        The first two data bytes carry the sequence number, so a dlc below
+        2 is raised to 2. Returns the amount of sent, received, lost and
+        reordered messages, sustained frames/s and latency percentiles [us].
+        NOTE: latencies of all messages are kept in memory.
+        '''
+        period_us = 1000000 // rate if rate else 0
+        tx_ticks = [0] * 256  # send time of the messages on the way
+        latency = []
+        sent = received = lost = reordered = 0
+        expected = 0
+        start = next_tx = last = time.ticks_us()
+        while received + lost < count:
+            now = time.ticks_us()
+            if (sent < count and
+                    (not period_us or time.ticks_diff(now, next_tx) >= 0) and
+                    not self._spi_read_reg(b'\x30')[0] & 0x08):
+                dlc = max(2, dlcs[sent % len(dlcs)])
+                can_id = ids[sent % len(ids)]
+                data = (sent & 0xFFFF).to_bytes(2, 'big') + bytes(dlc - 2)
+                tx_ticks[sent & 0xFF] = now
+                self.send_msg({'id': can_id, 'ext': can_id > 0x7FF,
+                               'data': data, 'dlc': dlc, 'rtr': False})
+                sent += 1
+                next_tx = time.ticks_add(next_tx, period_us)
+            self.check_rx()
+            while self._rx_buf:
+                dat = self._rx_buf.pop(0)
+                seq = (dat[5] << 8) | dat[6]
+                last = int.from_bytes(dat[13:], 'big')
+                latency.append(time.ticks_diff(last, tx_ticks[seq & 0xFF]))
+                received += 1
+                gap = (seq - expected) & 0xFFFF
+                if gap < 0x8000:
+                    lost += gap
+                    expected = (seq + 1) & 0xFFFF
+                else:
+                    # Late message, it was counted as lost.
+                    reordered += 1
+                    lost -= 1
+            if (sent == count and time.ticks_diff(
+                    time.ticks_us(), last) > timeout_ms * 1000):
+                lost = count - received
+                break
+
+        res = {'sent': sent, 'received': received, 'lost': lost,
+               'reordered': reordered, 'fps': 0}
+        elapsed = time.ticks_diff(last, start)
+        if received and elapsed > 0:
+            res['fps'] = received * 1000000 // elapsed
+        latency.sort()
+        for p in (50, 90, 99, 100):
+            res['p{}'.format(p)] = (
+                latency[min(len(latency) - 1, len(latency) * p // 100)]
+                if latency else None)
+        return res
+
+
+    def _triggered(self, dat, trigger: dict) -> bool:
+        '''
+        Checks the raw frame against the trigger conditions of `capture`.
+        '''
+        # Runs for every message until the trigger, so nothing is decoded.
+        if 'id' in trigger and _raw_id(dat) != trigger['id']:
+            return False
+        if 'ext' in trigger and bool(dat[1] & 0x08) != trigger['ext']:
+            return False
+        if 'mask' in trigger:
+            mask = trigger['mask']
+            value = trigger.get('value', bytes(len(mask)))
+            for i in range(len(mask)):
+                if dat[5 + i] & mask[i] != value[i] & mask[i]:
+                    return False
+        return 'id' in trigger or 'mask' in trigger
+
+
+    def capture(self,
+                pre: int = 192,
+                post: int = 64,
+                trigger: dict = None,
+                timeout_ms: int = 60000,
+                post_ms: int = 1000) -> tuple:
+        '''
+        Keeps the received messages in a ring buffer until the trigger fires,
+        then receives `post` more messages and returns the window.
+
+        trigger: dict with any of
+            'id': id of the trigger message
+            'ext': whether the trigger message is extended, any if missing
+            'mask', 'value': data bytes of the trigger message,
+                             data & mask == value & mask
+            'error': trigger on any error flag in EFLG register
+        Message conditions are combined, the error one works on its own.
+
+        Returns (window, index): window is the raw messages with timestamps,
+        FRAME_SIZE bytes each, oldest first, index is the position of the
+        trigger message in it (for the error trigger, of the last message
+        before the error). Returns None if nothing triggers in time.
+        If the `post` messages do not come within `post_ms` after the
+        trigger, e.g. the bus went quiet after an error, the window ends
+        with the ones received so far.
+        '''
+        trigger = trigger or {}
+        slots = pre + 1 + post
+        ring = bytearray(slots * FRAME_SIZE)
+        count = 0
+        stop = None
+        fired = 0
+        self._rx_buf = []
+        start = time.ticks_ms()
+        while stop is None or count < stop:
+            now = time.ticks_ms()
+            if stop is None:
+                if time.ticks_diff(now, start) >= timeout_ms:
+                    return None
+            elif time.ticks_diff(now, fired) >= post_ms:
+                break
+            self.check_rx()
+            while self._rx_buf:
+                dat = self._rx_buf.pop(0)
+                i = (count % slots) * FRAME_SIZE
+                ring[i:i + FRAME_SIZE] = dat
+                if stop is None and self._triggered(dat, trigger):
+                    stop = count + 1 + post
+                    fired = time.ticks_ms()
+                count += 1
+                if stop is not None and count >= stop:
+                    break
+            if (stop is None and trigger.get('error') and
+                    self._spi_read_reg(b'\x2d')[0]):
+                # The latest message is the last one before the error.
+                stop = count + post
+                fired = time.ticks_ms()
+
+        if count > slots:
+            i = (count % slots) * FRAME_SIZE
+            window = ring[i:] + ring[:i]
+        else:
+            window = ring[:count * FRAME_SIZE]
+        return bytes(window), stop - 1 - post - max(0, count - slots)
+
+
+    def stream(self,
+               duration_ms: int = 0,
+               reducer=None,
+               summary_ms: int = 1000) -> None:
+        '''
+        Prints every received message as a hex line of the raw Rx buffer
+        with timestamp, until `duration_ms` passes (0 means forever).
+
+        reducer: Reducer which decides what is worth forwarding, its summary
+                 of suppressed messages is printed every `summary_ms`
+                 as a line starting with `S `
+
+        `P` sent by the host is answered by `P ` line with `time.ticks_us()`,
+        so the host keeps its clock synchronized during the stream.
+        '''
+        import select
+        import sys
+        from ubinascii import hexlify
+        poll = select.poll()
+        poll.register(sys.stdin, select.POLLIN)
+        start = last_summary = time.ticks_ms()
+        self._rx_buf = []
+        while True:
+            now = time.ticks_ms()
+            if duration_ms and time.ticks_diff(now, start) >= duration_ms:
+                break
+            if poll.poll(0) and sys.stdin.read(1) == 'P':
+                print('P', time.ticks_us())
+            self.check_rx()
+            while self._rx_buf:
+                dat = self._rx_buf.pop(0)
+                if reducer is None or reducer.forward(dat):
+                    print(hexlify(dat).decode())
+            if (reducer is not None and
+                    time.ticks_diff(now, last_summary) >= summary_ms):
+                print('S', reducer.summary())
+                last_summary = now
+        if reducer is not None:
+            print('S', reducer.summary())
+
+
+    def serve(self, batch: int = 16, batch_ms: int = 5) -> None:
+        '''
+        Persistent session with the host, runs until interrupted (Ctrl-C).
+
+        Host to board lines:
+        `T` + hex of id (4 bytes), flags (bit 0 ext, bit 1 rtr), dlc, data
+        queues a message to be sent.
+        `P` asks for `P ` line with `time.ticks_us()` to synchronize the
+        clock.
+
+        Board to host lines:
+        `R` + hex of raw Rx buffers with timestamps, FRAME_SIZE bytes each,
+        printed once `batch` messages are collected or the oldest one waits
+        for `batch_ms`, so the serial link is not spent on line overhead.
+        `E` + message when a message cannot be sent.
+        '''
+        import select
+        import sys
+        from ubinascii import hexlify, unhexlify
+        poll = select.poll()
+        poll.register(sys.stdin, select.POLLIN)
+        cmd = []
+        tx = []
+        out = []
+        first = 0
+        sending = None
+        self._rx_buf = []
+        while True:
+            while poll.poll(0):
+                ch = sys.stdin.read(1)
+                if ch != '\n':
+                    cmd.append(ch)
+                    continue
+                line = ''.join(cmd)
+                cmd = []
+                if line.startswith('T'):
+                    tx.append(unhexlify(line[1:]))
+                elif line == 'P':
+                    print('P', time.ticks_us())
+            if tx and not self._spi_read_reg(b'\x30')[0] & 0x08:
+                dat = tx.pop(0)
+                sending = time.ticks_ms()
+                self.send_msg({'id': int.from_bytes(dat[:4], 'big'),
+                               'ext': bool(dat[4] & 0x01),
+                               'rtr': bool(dat[4] & 0x02),
+                               'dlc': dat[5], 'data': dat[6:]})
+            elif (sending is not None and
+                    self._spi_read_reg(b'\x30')[0] & 0x08 and
+                    time.ticks_diff(time.ticks_ms(), sending) > 1000):
+                # Abort, nobody acknowledges the message.
+                self._spi_write_bit(b'\x30', b'\x08', b'\x00')
+                sending = None
+                print('E message not acknowledged')
+            self.check_rx()
+            while self._rx_buf:
+                if not out:
+                    first = time.ticks_ms()
+                out.append(hexlify(self._rx_buf.pop(0)).decode())
+            if out and (len(out) >= batch or
+                        time.ticks_diff(time.ticks_ms(), first) >= batch_ms):
+                print('R' + ''.join(out))
+                out = []
+
+
     def recv_msg(self) -> dict:
         '''
         Requests whether the MCP2515 has received a message. If so, read it
@@ -234,7 +569,8 @@ select from {}'.format(''.join(speed.keys())))
         received frame, otherwise return None.
 
         Return Msg description:
-        msg ['tm']: Time to receive the message [ms]. Timer starts on power on.
+        msg ['tm']: Time to receive the message [us]. Timer starts on power on
+                    and wraps around, compare with `time.ticks_diff`.
         msg ['id']: ID of the received message
         msg ['ext']: Whether the received message is an extended frame
         msg ['data']: Received message data
@@ -245,9 +581,15 @@ select from {}'.format(''.join(speed.keys())))
         self.check_rx()
         if len(self._rx_buf) == 0:
             return None
-        dat = self._rx_buf.pop(0)
+        return self._decode(self._rx_buf.pop(0))
+
+
+    def _decode(self, dat) -> dict:
+        '''
+        Converts the raw Rx buffer with timestamp to message dict.
+        '''
         msg = {}
-        msg['tm'] = int.from_bytes(dat[-8:], 'big')
+        msg['tm'] = int.from_bytes(dat[13:], 'big')
         msg['dlc'] = int.from_bytes(dat[4: 5], 'big') & 0x0F
         msg['data'] = dat[5:13]
         # 0: standard frame 1: extended frame
@@ -267,6 +609,75 @@ select from {}'.format(''.join(speed.keys())))
         return msg
 
 
+    def recv_id(self, ids, timeout_ms: int = 1000) -> dict:
+        '''
+        Waits for a message with id from `ids` (any container supporting `in`,
+        a set is the fastest) and returns it, or None on timeout.
+        Up to RX_KEEP latest messages with other ids are kept in buffer for
+        `recv_msg`, the older ones are dropped.
+        '''
+        start = time.ticks_ms()
+        checked = 0
+        while time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+            self.check_rx()
+            # Only the new messages are checked, by the raw id.
+            while checked < len(self._rx_buf):
+                if _raw_id(self._rx_buf[checked]) in ids:
+                    return self._decode(self._rx_buf.pop(checked))
+                checked += 1
+            while checked > RX_KEEP:
+                self._rx_buf.pop(0)
+                checked -= 1
+        return None
+
+
+    def wait_tx(self, send_chanel: int = 0, timeout_ms: int = 100) -> bool:
+        '''
+        Waits until the channel has sent its message (TXREQ is cleared).
+        Returns False on timeout, e.g. when there is no one to acknowledge.
+        '''
+        ctl = (((send_chanel % 3) + 3) << 4) .to_bytes(1, 'big')
+        start = time.ticks_ms()
+        while self._spi_read_reg(ctl)[0] & 0x08:
+            if time.ticks_diff(time.ticks_ms(), start) >= timeout_ms:
+                return False
+        return True
+
+
+    def request(self, msg: dict, response_id: int,
+                timeout_ms: int = 1000) -> dict:
+        '''
+        Sends a message and waits for the response with `response_id`.
+        Returns the response or None on timeout.
+        '''
+        self.send_msg(msg)
+        return self.recv_id((response_id, ), timeout_ms)
+
+
+    def request_many(self, msgs: list, response_ids: list,
+                     timeout_ms: int = 1000) -> list:
+        '''
+        Sends the messages one by one and collects the messages with any of
+        `response_ids` in order of reception, until there is one for each
+        request or timeout.
+        '''
+        ids = set(response_ids)
+        res = []
+        for msg in msgs:
+            self.send_msg(msg)
+            self.wait_tx()
+            # Keep the receive buffers free while sending.
+            self.check_rx()
+        start = time.ticks_ms()
+        while len(res) < len(response_ids):
+            left = timeout_ms - time.ticks_diff(time.ticks_ms(), start)
+            msg = self.recv_id(ids, left) if left > 0 else None
+            if msg is None:
+                break
+            res.append(msg)
+        return res
+
+
     def get_smpl(self, printable=True):
         '''
         Query whether the MCP2515 has received a message. If so, deposit it in Buf. check_rx is called.
@@ -292,6 +703,8 @@ select from {}'.format(''.join(speed.keys())))
     def check_rx(self):
         '''
         Query whether the MCP2515 has received a message. If so, store it in Buf and return TRUE, otherwise return False.
+        Every frame is stamped with 4 bytes of `time.ticks_us()`, which is
+        enough as the ticks wrap around at 2**30.
         Note: Failure to store the messages in the MCP into Buf in time may result in the MCP being unable to receive new messages.
         In other words, packets may be lost.
         So, try to call this function as much as possible ~~
@@ -299,11 +712,11 @@ select from {}'.format(''.join(speed.keys())))
         rx_flag = int.from_bytes(self._spi_ReadStatus(), 'big')
         if (rx_flag & 0x01):
             dat = self._spi_RecvMsg(0)
-            tm = (time.ticks_ms()). to_bytes(8, 'big')
+            tm = (time.ticks_us()). to_bytes(4, 'big')
             self._rx_buf.append(dat + tm)
         if (rx_flag & 0x02):
             dat = self._spi_RecvMsg(1)
-            tm = (time.ticks_ms()). to_bytes(8, 'big')
+            tm = (time.ticks_us()). to_bytes(4, 'big')
             self._rx_buf.append(dat + tm)
         return True if (rx_flag & 0b11000000) else False
 
@@ -385,3 +798,227 @@ select from {}'.format(''.join(speed.keys())))
         self.cs.off()
         self.spi.write((0x80 + (select & 0x07)). to_bytes(1, 'big'))
         self.cs.on()
+
+
+class Reducer:
+    '''
+    Reduces the messages forwarded to the host: only the changed payloads
+    and/or limited rate per id.
+
+    The state is kept in a fixed table of `max_ids` slots (17 bytes of
+    arrays and about 12 bytes of the id dict each, ~30 bytes), the ids
+    above it are always forwarded.
+    '''
+
+    def __init__(self,
+                 change_only: bool = True,
+                 rate_limits: dict = None,
+                 max_ids: int = 128) -> None:
+        '''
+        change_only: forward a message only if its dlc or data differ from
+                     the last forwarded one with the same id
+        rate_limits: {id: Hz}, forward the id at most that often
+        max_ids: amount of ids to keep track of
+        '''
+        self.change_only = change_only
+        self.limits = {}
+        for can_id, hz in (rate_limits or {}).items():
+            self.limits[can_id] = 1000 // hz if hz else 0
+        self.max_ids = max_ids
+        self.slots = {}
+        self.last = bytearray(max_ids * 9)  # DLC and data bytes
+        self.forwarded = array('I', bytes(max_ids * 4))  # ticks [ms]
+        self.interval = array('H', bytes(max_ids * 2))  # [ms]
+        self.suppressed = array('H', bytes(max_ids * 2))
+
+
+    def _id(self, dat) -> int:
+        '''
+        Id of the raw message, standard and extended ones kept apart by
+        bit 29, so the key stays a small int and is not allocated.
+        '''
+        sid = (dat[0] << 3) | (dat[1] >> 5)
+        if dat[1] & 0x08:
+            return ((sid << 18) | ((dat[1] & 0x03) << 16) |
+                    (dat[2] << 8) | dat[3] | 0x20000000)
+        return sid
+
+
+    def forward(self, dat) -> bool:
+        '''
+        Decides whether the raw message goes to the host.
+        '''
+        key = self._id(dat)
+        slot = self.slots.get(key)
+        if slot is None:
+            if len(self.slots) == self.max_ids:
+                return True
+            slot = len(self.slots)
+            self.slots[key] = slot
+            self.interval[slot] = self.limits.get(key & 0x1FFFFFFF, 0)
+        else:
+            i = slot * 9
+            # DLC and the data bytes it covers, the rest of the Rx buffer is
+            # left over from the previous messages.
+            n = 1 + min(dat[4] & 0x0F, 8)
+            now = time.ticks_ms()
+            if ((self.change_only and self.last[i:i + n] == dat[4:4 + n]) or
+                    (self.interval[slot] and time.ticks_diff(
+                        now, self.forwarded[slot]) < self.interval[slot])):
+                if self.suppressed[slot] < 0xFFFF:
+                    self.suppressed[slot] += 1
+                return False
+        i = slot * 9
+        self.last[i:i + 9] = dat[4:13]
+        self.forwarded[slot] = time.ticks_ms() & 0x3FFFFFFF
+        return True
+
+
+    def summary(self) -> dict:
+        '''
+        Returns {id: amount} of the messages suppressed since the last
+        summary and resets the counters. Extended ids have bit 29 set.
+        '''
+        res = {}
+        for key, slot in self.slots.items():
+            if self.suppressed[slot]:
+                res[key] = self.suppressed[slot]
+                self.suppressed[slot] = 0
+        return res
+
+
+class IsoTp:
+    '''
+    Implements ISO 15765-2 (ISO-TP) segmentation on top of the CAN.
+
+    It runs on the board, so the flow control frames meet the protocol
+    timing regardless of the serial link to the host.
+    '''
+
+    def __init__(self, can: CAN, tx_id: int, rx_id: int, ext: bool = False,
+                 block_size: int = 0, st_min: int = 0,
+                 padding: int = 0xAA) -> None:
+        '''
+        can: started CAN interface
+        tx_id: id of the frames being sent
+        rx_id: id of the frames being received
+        ext: whether the ids are extended
+        block_size, st_min: flow control parameters offered to the sender,
+                            0 means no limits
+        padding: value of unused bytes of the frames
+        '''
+        self.can = can
+        self.tx_id = tx_id
+        self.rx_id = (rx_id, )
+        self.ext = ext
+        self.block_size = block_size
+        self.st_min = st_min
+        self.padding = padding
+
+
+    def _send_frame(self, data) -> None:
+        '''
+        Sends single padded frame and waits until it is on the bus.
+        '''
+        data = bytes(data) + bytes([self.padding]) * (8 - len(data))
+        self.can.send_msg({'id': self.tx_id, 'ext': self.ext, 'data': data,
+                           'dlc': 8, 'rtr': False})
+        if not self.can.wait_tx():
+            raise OSError('ISO-TP frame was not acknowledged.')
+
+
+    def _flow_control(self, timeout_ms: int) -> tuple:
+        '''
+        Waits for Clear To Send flow control frame.
+        Returns block size and separation time [us].
+        '''
+        while True:
+            msg = self.can.recv_id(self.rx_id, timeout_ms)
+            if msg is None:
+                raise OSError('ISO-TP flow control timeout.')
+            pci = msg['data'][0]
+            if pci >> 4 != 3:
+                continue
+            if pci & 0x0F == 0:  # Clear To Send
+                st = msg['data'][2]
+                if st <= 0x7F:
+                    st_us = st * 1000
+                elif 0xF1 <= st <= 0xF9:
+                    st_us = (st - 0xF0) * 100
+                else:
+                    st_us = 127000
+                return msg['data'][1], st_us
+            if pci & 0x0F == 2:
+                raise OSError('ISO-TP receiver overflow.')
+            # Wait, the receiver will send another flow control frame.
+
+
+    def send(self, data, timeout_ms: int = 1000) -> None:
+        '''
+        Sends the data of up to 4095 bytes.
+        '''
+        size = len(data)
+        if size > 0xFFF:
+            raise ValueError('ISO-TP data over 4095 bytes.')
+        if size <= 7:
+            self._send_frame(bytes([size]) + data)
+            return
+        self._send_frame(bytes([0x10 | (size >> 8) & 0x0F, size & 0xFF]) +
+                         data[:6])
+        block_size, st_us = self._flow_control(timeout_ms)
+        sn = 1
+        sent = 0
+        for i in range(6, size, 7):
+            if block_size and sent == block_size:
+                block_size, st_us = self._flow_control(timeout_ms)
+                sent = 0
+            elif st_us:
+                time.sleep_us(st_us)
+            self._send_frame(bytes([0x20 | sn]) + data[i:i + 7])
+            sn = (sn + 1) & 0x0F
+            sent += 1
+
+
+    def recv(self, timeout_ms: int = 1000) -> bytes:
+        '''
+        Receives the data, returns None on timeout.
+        '''
+        while True:
+            msg = self.can.recv_id(self.rx_id, timeout_ms)
+            if msg is None:
+                return None
+            data = msg['data']
+            if data[0] >> 4 == 0:  # Single Frame
+                return bytes(data[1:1 + (data[0] & 0x0F)])
+            if data[0] >> 4 == 1:  # First Frame
+                break
+        size = ((data[0] & 0x0F) << 8) | data[1]
+        buf = bytearray(data[2:8])
+        self._send_frame(bytes([0x30, self.block_size, self.st_min]))
+        sn = 1
+        received = 0
+        while len(buf) < size:
+            msg = self.can.recv_id(self.rx_id, timeout_ms)
+            if msg is None:
+                raise OSError('ISO-TP consecutive frame timeout.')
+            data = msg['data']
+            if data[0] >> 4 != 2:
+                continue
+            if data[0] & 0x0F != sn:
+                raise OSError('ISO-TP wrong sequence number.')
+            buf.extend(data[1:8])
+            sn = (sn + 1) & 0x0F
+            received += 1
+            if (self.block_size and received == self.block_size and
+                    len(buf) < size):
+                self._send_frame(bytes([0x30, self.block_size, self.st_min]))
+                received = 0
+        return bytes(buf[:size])
+
+
+    def request(self, data, timeout_ms: int = 1000) -> bytes:
+        '''
+        Sends the data and receives the response, e.g. UDS service call.
+        '''
+        self.send(data, timeout_ms)
+        return self.recv(timeout_ms)
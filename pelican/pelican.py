@@ -20,18 +20,38 @@
 # SOFTWARE.
 
 
+import ast
+import base64
 import os
+import time
+from typing import List, Optional
+
 import yaml
 
 try:
     from ampy.files import Files
+    from ampy.pyboard import PyboardError
 except Exception as e:
     raise Exception(f'Cannot import ampy {e}')
 
+from pelican import capture
+from pelican.bittiming import SPEEDS
+from pelican.clock import ClockSync, ticks_diff
+from pelican.link import Link
+from pelican.waiters import Waiters
+
 
-BUFFER_SIZE = 32  # Amount of data to read or write to the serial port at a time.
+BUFFER_SIZE = 32  # Initial amount of data to write to the serial port at a time.
 # This is kept small because small chips and USB to serial
-# bridges usually have very small buffers.
+# bridges usually have very small buffers, `Link` grows it while the
+# board keeps up.
+
+SYNC_PINGS = 8  # Amount of ping exchanges per clock synchronization.
+
+SETUP_CODE = ('from mcpcan import CAN\n'
+              'can = CAN(cs={0})\n'
+              'can.start(speed_cfg={1}, crystal={2}, filter={3}, '
+              'listen_only={4}, loopback={5})')  # Executed line by line.
 
 
 class Pelican():
@@ -44,6 +64,8 @@ class Pelican():
         '''
         self._pyboard = pyboard
         self.CAN_MODULE = 'mcpcan.py'
+        self.clock = ClockSync()
+        self.link = Link(pyboard, BUFFER_SIZE)
 
 
     def _read_config(self, config: str) -> None:
@@ -68,74 +90,375 @@ class Pelican():
             path = os.path.dirname(__file__)
             with open(os.path.join(path, self.CAN_MODULE), "rb") as infile:
                 data = infile.read()
-            board.put(self.CAN_MODULE, data)
+            self.link.put(self.CAN_MODULE, data)
 
 
-    def dump(self, config_file: str) -> None:
+    def _sync_clock(self, pings: int = SYNC_PINGS) -> None:
         '''
-        Gets the message from CAN buffer.
+        Correlates the board ticks with the host clock.
 
-        Example:
-        pelican -p /dev/ttyUSB0 -b 115200 dump
+        The pings add up over the sessions of this instance, so the drift
+        is estimated once they span `clock.DRIFT_SPAN`; long sessions ping
+        in band while they run.
+
+        Must be called while the board is in raw REPL.
+        '''
+        self._pyboard.exec('import time')
+        for _ in range(pings):
+            host_send = time.time()
+            ticks = self._pyboard.exec('print(time.ticks_us())')
+            host_recv = time.time()
+            self.clock.add(host_send, int(ticks), host_recv)
+
+
+    def _parse_frame(self, output: bytes):
+        '''
+        Converts the printed frame (or list of them) to dict with host
+        wall-clock timestamp.
+        '''
+        frame = ast.literal_eval(output.decode().strip())
+        if isinstance(frame, list):
+            for item in frame:
+                item['host_tm'] = self.clock.to_host(item['tm'])
+        elif frame is not None:
+            frame['host_tm'] = self.clock.to_host(frame['tm'])
+        return frame
+
+
+    def _setup_code(self, config_file: str, loopback: bool = False,
+                    listen_only: bool = None) -> str:
+        '''
+        Code to initialize CAN on the board according to the config file.
+
+        loopback: receive own messages only, without the bus
+        listen_only: overrides the mode of the config file
         '''
         self._check_onboard_file()
 
         conf = self._read_config(config_file)
 
-        code = '''\
-from mcpcan import CAN
-can = CAN(cs={0})
-can.start(speed_cfg={1}, crystal={2}, filter={3}, listen_only={4})
-res = can.recv_msg()
-print(res)\
-'''.format(conf['cs'],
-           conf['speed'],
-           conf['crystal'],
-           conf['filter'],
-           conf['l'])
+        return SETUP_CODE.format(conf['cs'],
+                                 conf['speed'],
+                                 conf['crystal'],
+                                 conf['filter'],
+                                 conf['l'] if listen_only is None
+                                 else listen_only,
+                                 loopback)
+
 
+    def _run(self, code: str, sync: bool = False,
+             timeout: float = None) -> bytes:
+        '''
+        Executes the code on the board line by line in one raw REPL session
+        and returns the output of the last line.
+
+        sync: whether to synchronize the clock for the received frames
+        timeout: time [s] a line may run without any output, for the lines
+                 running longer than the default of the pyboard
+        '''
         self._pyboard.enter_raw_repl()
 
         for line in code.split('\n'):
-            result = self._pyboard.exec(line)
+            if timeout is None:
+                result = self._pyboard.exec(line)
+            else:
+                result, error = self._pyboard.exec_raw(line, timeout)
+                if error:
+                    raise PyboardError('exception', result, error)
+        if sync:
+            self._sync_clock()
         self._pyboard.exit_raw_repl()
 
-        return result.decode()
+        return result
 
 
-    def send(self, message, config_file) -> None:
+    def dump(self, config_file: str) -> dict:
+        '''
+        Gets the message from CAN buffer.
+
+        The frame is extended with `host_tm`, the host wall-clock time [s]
+        of the reception, or None is returned if the buffer is empty.
+
+        Example:
+        pelican -p /dev/ttyUSB0 -b 115200 dump
+        '''
+        code = self._setup_code(config_file) + '''
+res = can.recv_msg()
+print(res)'''
+
+        return self._parse_frame(self._run(code, sync=True))
+
+
+    def send(self, message, config_file) -> str:
         '''
         Sends the CAN message.
 
         Example:
         pelican -p /dev/ttyUSB0 -b 115200 send -i 123 -d Hello111 -l8 -r False
         '''
-        self._check_onboard_file()
-
-        conf = self._read_config(config_file)
+        code = self._setup_code(config_file)
 
         # Make the data to appear as byte array
         message['data'] = message['data'].encode('utf-8')
 
-        code = '''\
-from mcpcan import CAN
-can = CAN(cs={0})
-can.start(speed_cfg={1}, crystal={2}, filter={3}, listen_only={4})
-can.send_msg({5})\
-'''.format(conf['cs'],
-           conf['speed'],
-           conf['crystal'],
-           conf['filter'],
-           conf['l'],
-           message)
+        code += '''
+can.send_msg({0})'''.format(message)
+
+        return self._run(code).decode()
+
+
+    def request(self, message: dict, response_id: int, config_file: str,
+                timeout: float = 1.0) -> dict:
+        '''
+        Sends the CAN message and waits for the response with `response_id`
+        within the same session, so the response cannot be missed.
+        Returns the response frame or None on timeout.
+
+        Example:
+        pelican -p /dev/ttyUSB0 request -i 0x7DF -d 0201 -l8 -a 0x7E8
+        '''
+        code = self._setup_code(config_file) + '''
+res = can.request({0}, {1}, {2})
+print(res)'''.format(message, response_id, int(timeout * 1000))
+
+        return self._parse_frame(self._run(code, sync=True,
+                                           timeout=timeout + 10))
+
+
+    def request_many(self, requests: list, config_file: str,
+                     timeout: float = 1.0) -> list:
+        '''
+        Sends all the messages and collects their responses at once.
+
+        requests: list of (message, response_id) pairs
+        Returns the response frames in order of the requests, with None for
+        the ones without response within the timeout.
+        '''
+        waiters = Waiters()
+        pending = [waiters.register(rid) for _, rid in requests]
+
+        code = self._setup_code(config_file) + '''
+res = can.request_many({0}, {1}, {2})
+print(res)'''.format([msg for msg, _ in requests],
+                     [rid for _, rid in requests],
+                     int(timeout * 1000))
+
+        output = self._run(code, sync=True, timeout=timeout + 10)
+        for frame in self._parse_frame(output):
+            waiters.dispatch(frame)
+
+        return [waiter.frame for waiter in pending]
+
+
+    def isotp_request(self, data: bytes, tx_id: int, rx_id: int,
+                      config_file: str, timeout: float = 1.0,
+                      ext: bool = False) -> bytes:
+        '''
+        Sends the data via ISO-TP and returns the response data, e.g. UDS
+        service call. Returns None if there is no response in the timeout.
+
+        Example:
+        pelican -p /dev/ttyUSB0 isotp -t 0x7E0 -r 0x7E8 -d 22F190
+        '''
+        code = self._setup_code(config_file) + '''
+from mcpcan import IsoTp
+tp = IsoTp(can, {0}, {1}, ext={2})
+res = tp.request({3!r}, {4})
+print(res)'''.format(tx_id, rx_id, ext, bytes(data), int(timeout * 1000))
+
+        # Both sending and receiving may wait for the timeout.
+        output = self._run(code, timeout=2 * timeout + 10)
+        return ast.literal_eval(output.decode().strip())
+
+
+    def autobaud(self, config_file: str, window: float = 0.5) -> int:
+        '''
+        Detects the communication speed of the bus in Kb/s, listening to
+        every supported speed for `window` seconds. Returns None if no speed
+        fits.
+
+        Example:
+        pelican -p /dev/ttyUSB0 autobaud --save
+        '''
+        conf = self._read_config(config_file)
+
+        # Listen only, so the bus is not disturbed before the detection.
+        code = self._setup_code(config_file, listen_only=True) + '''
+res = can.autobaud({0}, None, {1})
+print(res)'''.format(conf['crystal'], int(window * 1000))
+
+        # The board prints nothing until every speed is tried.
+        output = self._run(code, timeout=len(SPEEDS) * window + 10)
+        return ast.literal_eval(output.decode().strip())
+
+
+    def capture(self, config_file: str, trigger: dict, pre: int = 192,
+                post: int = 64, timeout: float = 60.0,
+                post_timeout: float = 1.0) -> Optional[list]:
+        '''
+        Captures the frames around the trigger on the board and uploads the
+        window in one bulk transfer. The trigger frame is marked with
+        `trigger` key. Returns None if nothing triggers within the timeout.
+
+        trigger: dict with any of
+            'id': id of the trigger frame
+            'ext': whether the trigger frame is extended, any if missing
+            'mask', 'value': data bytes of the trigger frame,
+                             data & mask == value & mask
+            'error': trigger on CAN error flags
+        post_timeout: time [s] to wait for the `post` frames after the
+                      trigger, the window ends with the ones received
+
+        The window may be older than the tick period of the board, so it is
+        unwrapped from its newest frame backwards, which works as long as
+        no two consecutive frames are half a period (~537 s) apart.
+
+        Example:
+        pelican -p /dev/ttyUSB0 capture -i 0x123 --pre 100 -o fault.plcn
+        '''
+        code = self._setup_code(config_file) + '''
+import ubinascii
+res = can.capture({0}, {1}, {2}, {3}, {4})
+print(res and (ubinascii.b2a_base64(res[0]), res[1]))'''.format(
+            pre, post, trigger, int(timeout * 1000), int(post_timeout * 1000))
+
+        # Raw REPL has no binary output, base64 is the most compact text.
+        output = self._run(code, sync=True,
+                           timeout=timeout + post_timeout + 10)
+        uploaded = time.time()
+        res = ast.literal_eval(output.decode().strip())
+        if res is None:
+            return None
+
+        frames = list(capture.split(base64.b64decode(res[0])))
+        # The newest frame came right before the upload.
+        near, newer = uploaded, None
+        for frame in reversed(frames):
+            if newer is not None:
+                near -= ticks_diff(newer, frame['tm']) / 1e6
+            frame['host_tm'] = self.clock.to_host(frame['tm'], near)
+            near, newer = frame['host_tm'], frame['tm']
+        for i, frame in enumerate(frames):
+            frame['trigger'] = i == res[1]
+        return frames
+
+
+    def monitor(self, config_file: str, on_frame, on_summary=None,
+                duration: float = 0, change_only: bool = False,
+                rate_limits: dict = None, summary: float = 1.0) -> None:
+        '''
+        Streams the received frames to `on_frame` callback for `duration`
+        seconds (0 means until interrupted).
+
+        The reduction runs on the board, so the unchanged payloads
+        (change_only) or the ids over their rate ({id: Hz} rate_limits) do
+        not load the serial link. Every `summary` seconds `on_summary` gets
+        {(id, ext): amount} of the suppressed frames.
+
+        The clock is pinged in band every `clock.RESYNC_PERIOD`, so the
+        timestamps follow the drift of the board.
+        A board exception ends the stream with PyboardError.
+
+        Example:
+        pelican -p /dev/ttyUSB0 monitor --changes --limit 0x123:10
+        '''
+        reducer = None
+        if change_only or rate_limits:
+            reducer = 'Reducer({0}, {1})'.format(change_only, rate_limits)
+
+        code = self._setup_code(config_file) + '''
+from mcpcan import Reducer
+reducer = {0}'''.format(reducer)
+
+        ping: List[float] = []  # host time of the ping in flight
+
+        def handle(text: str, now: float) -> None:
+            if text.startswith('S '):
+                if on_summary is not None:
+                    suppressed = ast.literal_eval(text[2:])
+                    on_summary({(key & 0x1FFFFFFF, bool(key & 0x20000000)): n
+                                for key, n in suppressed.items()})
+            elif text.startswith('P ') and ping:
+                self.clock.add(ping.pop(), int(text[2:]), now)
+            elif len(text) == 2 * capture.FRAME_SIZE:
+                frame = capture.decode(bytes.fromhex(text))
+                frame['host_tm'] = self.clock.to_host(frame['tm'], now)
+                on_frame(frame)
 
         self._pyboard.enter_raw_repl()
 
-        for line in code.split('\n'):
-            result = self._pyboard.exec(line)
-        self._pyboard.exit_raw_repl()
+        for code_line in code.split('\n'):
+            self._pyboard.exec(code_line)
+        self._sync_clock()
+        serial = self._pyboard.serial
+        serial_timeout = serial.timeout
+        deadline = time.time() + duration + 10 if duration else None
+        try:
+            self._pyboard.exec_raw_no_follow(
+                'can.stream({0}, reducer, {1})'.format(int(duration * 1000),
+                                                       int(summary * 1000)))
+            # `Pyboard.follow` keeps the whole output until the stream ends,
+            # so the port is read line by line instead.
+            serial.timeout = 0.1
+            line = b''
+            while True:
+                line += serial.readline()
+                if b'\x04' in line:
+                    # The raw REPL ends the execution with EOT and the
+                    # error output.
+                    if line.count(b'\x04') < 2:
+                        serial.timeout = 1.0
+                        line += serial.read_until(b'\x04')
+                    error = line.split(b'\x04')[1]
+                    if error:
+                        raise PyboardError('exception', b'', error)
+                    break
+                now = time.time()
+                if line.endswith(b'\n'):
+                    handle(line.decode().strip(), now)
+                    line = b''
+                if ping and now - ping[0] > 1.0:
+                    ping.clear()  # The reply got lost.
+                if not ping and self.clock.due(now):
+                    ping.append(now)
+                    serial.write(b'P')
+                if deadline is not None and now > deadline:
+                    raise PyboardError('timeout waiting for the stream end')
+        except KeyboardInterrupt:
+            # Stop the board as well.
+            serial.write(b'\x03')
+        finally:
+            serial.timeout = serial_timeout
+            self._pyboard.exit_raw_repl()
+
+
+    def stress(self, config_file: str, count: int = 1000, rate: int = 0,
+               ids: tuple = (0x100, ), dlcs: tuple = (8, )) -> dict:
+        '''
+        Runs the stress generator on the board in loopback mode, so no other
+        CAN node is needed. Returns the amount of lost and reordered
+        messages, sustained frames/s and latency percentiles [us].
+
+        Example:
+        pelican -p /dev/ttyUSB0 stress -n 5000 -i 0x100 -i 0x18ff50e5
+        '''
+        code = self._setup_code(config_file, loopback=True) + '''
+res = can.stress({0}, {1}, {2}, {3})
+print(res)'''.format(count, rate, tuple(ids), tuple(dlcs))
+
+        # Assume at least 1000 frames/s when sending as fast as possible.
+        output = self._run(code, timeout=count / (rate or 1000) + 10)
+        return ast.literal_eval(output.decode().strip())
 
-        return (result.decode())
+
+    def linktest(self, size: int = 4096, frames: int = 1000) -> dict:
+        '''
+        Measures the throughput of the serial link to the board.
+
+        Example:
+        pelican -p /dev/ttyUSB0 -r 921600 linktest
+        '''
+        return self.link.test(size, frames)
 
 
     def blink(self) -> None:
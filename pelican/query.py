@@ -0,0 +1,178 @@
+# Pelican - Capture files query engine
+# Author: Oleksandr Ivanchuk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from pelican import capture
+
+
+CHUNK_RECORDS = 1 << 18  # Records scanned by a worker at a time (6 MB).
+
+
+class Query():
+    '''
+    Predicates on the frames of capture files, all of them must match.
+    None means any value.
+    '''
+    def __init__(self,
+                 ids=None,
+                 ext: Optional[bool] = None,
+                 rtr: Optional[bool] = None,
+                 dlc: Optional[int] = None,
+                 data: Optional[bytes] = None,
+                 mask: Optional[bytes] = None,
+                 start: Optional[float] = None,
+                 end: Optional[float] = None) -> None:
+        '''
+        ids: collection of the frame ids
+        data, mask: data bytes of the frame, frame data & mask ==
+                    data & mask, mask defaults to all bits of the given
+                    data bytes
+        start, end: host time range [s], the end is excluded
+        '''
+        self.ids = None if ids is None else frozenset(ids)
+        self.ext = ext
+        self.rtr = rtr
+        self.dlc = dlc
+        self.mask = None
+        if data is not None:
+            mask = b'\xff' * len(data) if mask is None else mask
+            # Compare the data as 8 byte integers, one operation per frame.
+            self.mask = int.from_bytes(mask.ljust(8, b'\x00')[:8], 'big')
+            self.value = int.from_bytes(data.ljust(8, b'\x00')[:8],
+                                        'big') & self.mask
+        self.start = start
+        self.end = end
+
+
+    def match(self, host_tm: float, can_id: int, flags: int, dlc: int,
+              data: bytes) -> bool:
+        '''
+        Checks the unpacked capture record.
+        '''
+        if self.ids is not None and can_id not in self.ids:
+            return False
+        if self.ext is not None and bool(flags & capture.EXT) != self.ext:
+            return False
+        if self.rtr is not None and bool(flags & capture.RTR) != self.rtr:
+            return False
+        if self.dlc is not None and dlc != self.dlc:
+            return False
+        if (self.mask is not None and
+                int.from_bytes(data, 'big') & self.mask != self.value):
+            return False
+        if self.start is not None and host_tm < self.start:
+            return False
+        if self.end is not None and host_tm >= self.end:
+            return False
+        return True
+
+
+def _chunks(paths: List[str], size: int = CHUNK_RECORDS) -> list:
+    '''
+    Splits the capture files into record aligned (path, offset, records).
+    '''
+    chunks = []
+    for path in paths:
+        capture.check(path)
+        records = (os.path.getsize(path) - capture.HEADER.size) // \
+            capture.RECORD.size
+        for first in range(0, records, size):
+            offset = capture.HEADER.size + first * capture.RECORD.size
+            chunks.append((path, offset, min(size, records - first)))
+    return chunks
+
+
+def _scan(path: str, offset: int, records: int, query: Query,
+          limit: int) -> tuple:
+    '''
+    Worker scanning one chunk. Returns the partial aggregation, the matching
+    records stay packed, so nothing is pickled per frame:
+    (count, first time, first record, last time, last record, records)
+    '''
+    with open(path, 'rb') as capture_file:
+        capture_file.seek(offset)
+        buf = capture_file.read(records * capture.RECORD.size)
+
+    count = 0
+    first = last = None
+    first_tm = last_tm = None
+    matches = bytearray()
+    size = capture.RECORD.size
+    for i, record in enumerate(capture.RECORD.iter_unpack(buf)):
+        if not query.match(*record):
+            continue
+        count += 1
+        if first_tm is None or record[0] < first_tm:
+            first_tm, first = record[0], buf[i * size:(i + 1) * size]
+        if last_tm is None or record[0] >= last_tm:
+            last_tm, last = record[0], buf[i * size:(i + 1) * size]
+        if len(matches) < limit * size:
+            matches += buf[i * size:(i + 1) * size]
+    return count, first_tm, first, last_tm, last, bytes(matches)
+
+
+def run(paths: List[str], query: Query, workers: Optional[int] = None,
+        limit: int = 0, chunk: int = CHUNK_RECORDS) -> dict:
+    '''
+    Scans the capture files in parallel on `workers` processes (all cores by
+    default) and aggregates the matching frames.
+
+    limit: amount of the matching frames to return in `frames`,
+           in order of the files
+    Returns {'count', 'first', 'last', 'rate', 'frames'}, where first and
+    last are the earliest and the latest frame and rate is in frames/s.
+    '''
+    chunks = _chunks(paths, chunk)
+    args = [part + (query, limit) for part in chunks]
+    if workers == 1 or len(chunks) <= 1:
+        partials = [_scan(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            partials = list(pool.map(_scan, *zip(*args)))
+
+    total = 0
+    first_tm: Optional[float] = None
+    last_tm: Optional[float] = None
+    first_frame: Optional[dict] = None
+    last_frame: Optional[dict] = None
+    frames: List[dict] = []
+    size = capture.RECORD.size
+    for count, p_first_tm, first, p_last_tm, last, matches in partials:
+        if not count:
+            continue
+        total += count
+        if first_tm is None or p_first_tm < first_tm:
+            first_tm, first_frame = p_first_tm, capture.unpack(first)
+        if last_tm is None or p_last_tm >= last_tm:
+            last_tm, last_frame = p_last_tm, capture.unpack(last)
+        for i in range(0, len(matches), size):
+            if len(frames) < limit:
+                frames.append(capture.unpack(matches[i:i + size]))
+    rate = None
+    if (total > 1 and first_tm is not None and last_tm is not None and
+            last_tm > first_tm):
+        rate = (total - 1) / (last_tm - first_tm)
+    return {'count': total, 'first': first_frame, 'last': last_frame,
+            'rate': rate, 'frames': frames}
@@ -0,0 +1,107 @@
+# Pelican - Response waiters
+# Author: Oleksandr Ivanchuk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import threading
+from collections import deque
+from typing import Optional
+
+
+class Waiter():
+    '''
+    Pending response to a request.
+    '''
+    def __init__(self, can_id: int) -> None:
+        self.id = can_id
+        self.frame: Optional[dict] = None
+        self._event = threading.Event()
+
+
+    def resolve(self, frame: dict) -> None:
+        '''
+        Hands the response over to the waiting side.
+        '''
+        self.frame = frame
+        self._event.set()
+
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[dict]:
+        '''
+        Blocks until the response arrives, returns None on timeout.
+        '''
+        self._event.wait(timeout)
+        return self.frame
+
+
+class Waiters():
+    '''
+    Registry of pending responses indexed by the CAN id.
+
+    The responses with the same id resolve the requests in the order the
+    requests were registered, so dispatching a frame costs O(1) regardless
+    of how many requests are pending.
+    '''
+    def __init__(self) -> None:
+        self._pending: dict = {}
+        self._lock = threading.Lock()
+
+
+    def register(self, can_id: int) -> Waiter:
+        '''
+        Registers a request waiting for a frame with `can_id`.
+        '''
+        waiter = Waiter(can_id)
+        with self._lock:
+            self._pending.setdefault(can_id, deque()).append(waiter)
+        return waiter
+
+
+    def cancel(self, waiter: Waiter) -> None:
+        '''
+        Forgets the request, e.g. after its timeout.
+        '''
+        with self._lock:
+            queue = self._pending.get(waiter.id)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    del self._pending[waiter.id]
+
+
+    def dispatch(self, frame: dict) -> bool:
+        '''
+        Resolves the oldest request waiting for the frame id.
+        Returns False if nobody waits for it.
+        '''
+        with self._lock:
+            queue = self._pending.get(frame['id'])
+            if not queue:
+                return False
+            waiter = queue.popleft()
+            if not queue:
+                del self._pending[frame['id']]
+        waiter.resolve(frame)
+        return True
+
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(queue) for queue in self._pending.values())
@@ -45,6 +45,9 @@ setup(
     author_email='sashkoiv@gmail.com',
 
     install_requires=requirements,
+    extras_require={
+        'python-can': ['python-can'],
+    },
 
     license='MIT',
 
@@ -56,5 +59,8 @@ setup(
         'console_scripts': [
             'pelican=pelican.cli:cli',
         ],
+        'can.interface': [
+            'pelican=pelican.interface:PelicanBus',
+        ],
     },
 )
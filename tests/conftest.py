@@ -0,0 +1,23 @@
+import binascii
+import importlib
+import sys
+
+import pytest
+
+from mcp2515 import MCP2515, Clock, machine
+
+
+@pytest.fixture
+def chip(monkeypatch):
+    '''
+    Emulated MCP2515 with `mcpcan` module imported against it.
+    The module is available as `chip.mcpcan`.
+    '''
+    chip = MCP2515()
+    monkeypatch.setitem(sys.modules, 'machine', machine(chip))
+    monkeypatch.setitem(sys.modules, 'ubinascii', binascii)
+    monkeypatch.delitem(sys.modules, 'pelican.mcpcan', raising=False)
+    chip.mcpcan = importlib.import_module('pelican.mcpcan')
+    chip.clock = Clock()
+    monkeypatch.setattr(chip.mcpcan, 'time', chip.clock)
+    return chip
@@ -0,0 +1,188 @@
+'''
+Register-level MCP2515 emulator to run `mcpcan.py` on the host.
+'''
+import types
+from collections import deque
+
+
+class Clock():
+    '''
+    Virtual `time` module of micropython. Every reading advances the clock,
+    so the busy loops on the board terminate.
+    '''
+    TICKS_PERIOD = 1 << 30
+
+    def __init__(self, step_us=10):
+        self.us = 0
+        self.step_us = step_us
+
+    def ticks_us(self):
+        self.us += self.step_us
+        return self.us % self.TICKS_PERIOD
+
+    def ticks_ms(self):
+        return self.ticks_us() // 1000
+
+    def ticks_add(self, ticks, delta):
+        return (ticks + delta) % self.TICKS_PERIOD
+
+    def ticks_diff(self, new, old):
+        half = self.TICKS_PERIOD // 2
+        return ((new - old + half) % self.TICKS_PERIOD) - half
+
+    def sleep_us(self, us):
+        self.us += us
+
+    def sleep_ms(self, ms):
+        self.us += ms * 1000
+
+    def sleep(self, s):
+        self.us += int(s * 1000000)
+
+
+class MCP2515():
+    '''
+    The chip behind the SPI: registers, instructions and the Rx/Tx buffers.
+
+    Frames sent in normal mode are acknowledged and passed to `on_tx`,
+    in loopback mode they are received back.
+    '''
+    def __init__(self):
+        self.regs = bytearray(128)
+        self.on_tx = None
+        self.pending = deque()
+        self._cmd = None
+        self.reset()
+
+    def reset(self):
+        self.regs[:] = bytes(128)
+        self.regs[0x0E] = 0x80  # CANSTAT: configuration mode
+        self.regs[0x0F] = 0x87  # CANCTRL
+
+    @property
+    def mode(self):
+        return self.regs[0x0E] & 0xE0
+
+    def select(self):
+        while self.pending and not self.regs[0x2C] & 0x01:
+            self.receive(self.pending.popleft())
+        self._cmd = bytearray()
+
+    def deselect(self):
+        cmd, self._cmd = self._cmd, None
+        if not cmd:
+            return
+        if cmd[0] == 0xC0:
+            self.reset()
+        elif cmd[0] == 0x02:
+            for i, value in enumerate(cmd[2:]):
+                self._write(cmd[1] + i, value)
+        elif cmd[0] == 0x05:
+            addr, mask, value = cmd[1:4]
+            self._write(addr, (self.regs[addr] & ~mask) | (value & mask))
+        elif cmd[0] == 0x90:
+            self.regs[0x2C] &= ~0x01
+        elif cmd[0] == 0x94:
+            self.regs[0x2C] &= ~0x02
+        elif cmd[0] & 0xF8 == 0x80:
+            for n in range(3):
+                if cmd[0] & (1 << n):
+                    self.regs[0x30 + 0x10 * n] |= 0x08
+                    self._transmit(n)
+
+    def write(self, data):
+        self._cmd.extend(data)
+
+    def read(self, num):
+        cmd = self._cmd
+        if cmd[0] == 0x03:
+            return bytes(self.regs[cmd[1]:cmd[1] + num])
+        if cmd[0] == 0xA0:
+            intf = self.regs[0x2C]
+            status = intf & 0x03
+            for n in range(3):
+                txreq = (self.regs[0x30 + 0x10 * n] >> 3) & 1
+                status |= txreq << (2 + 2 * n)
+                status |= ((intf >> (2 + n)) & 1) << (3 + 2 * n)
+            return bytes([status])
+        if cmd[0] in (0x90, 0x94):
+            base = 0x61 if cmd[0] == 0x90 else 0x71
+            return bytes(self.regs[base:base + num])
+        raise NotImplementedError(hex(cmd[0]))
+
+    def _write(self, addr, value):
+        self.regs[addr] = value
+        if addr == 0x0F:
+            self.regs[0x0E] = (self.regs[0x0E] & 0x1F) | (value & 0xE0)
+        elif addr in (0x30, 0x40, 0x50) and value & 0x08:
+            self._transmit((addr - 0x30) // 0x10)
+
+    def _transmit(self, n):
+        if self.mode not in (0x00, 0x40):
+            return
+        base = 0x30 + 0x10 * n
+        frame = bytes(self.regs[base + 1:base + 14])
+        self.regs[base] &= ~0x08
+        self.regs[0x2C] |= 0x04 << n
+        if self.mode == 0x40:
+            self.receive(frame)
+        elif self.on_tx is not None:
+            self.on_tx(frame)
+
+    def receive(self, frame):
+        '''
+        Puts the raw frame (SIDH, SIDL, EID8, EID0, DLC, D0..D7) into the
+        first free Rx buffer.
+        '''
+        frame = bytes(frame) + bytes(13 - len(frame))
+        if not self.regs[0x2C] & 0x01:
+            self.regs[0x61:0x6E] = frame
+            self.regs[0x2C] |= 0x01
+        elif self.regs[0x60] & 0x04 and not self.regs[0x2C] & 0x02:
+            self.regs[0x71:0x7E] = frame
+            self.regs[0x2C] |= 0x02
+        else:
+            self.regs[0x2D] |= 0x40  # RX0OVR
+
+    def feed(self, *frames):
+        '''
+        Queues the frames sent by other nodes, each one is received once
+        the Rx buffer is free, as if the bus was busy until then.
+        '''
+        self.pending.extend(frames)
+
+
+def machine(chip):
+    '''
+    Builds `machine` module with Pin and SPI wired to the chip.
+    '''
+    class Pin():
+        OUT = 1
+        IN = 0
+
+        def __init__(self, num, mode=None, value=None):
+            self.num = num
+
+        def on(self):
+            chip.deselect()
+
+        def off(self):
+            chip.select()
+
+    class SPI():
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def init(self, *args, **kwargs):
+            pass
+
+        def write(self, data):
+            chip.write(data)
+
+        def read(self, num):
+            return chip.read(num)
+
+    module = types.ModuleType('machine')
+    module.Pin = Pin
+    module.SPI = SPI
+    return module
@@ -0,0 +1,51 @@
+import os
+
+from pytest import approx
+
+import pelican
+from pelican.bittiming import generate, solve
+
+
+def test_solve():
+    '''
+    Test `solve` keeps the bitrate and segment limits.
+    '''
+    for crystal in (8, 16, 20):
+        for speed in (10, 125, 250, 500):
+            cnf3, cnf2, cnf1 = solve(crystal, speed)
+            brp = cnf1 & 0x3F
+            prop = (cnf2 & 0x07) + 1
+            ps1 = ((cnf2 >> 3) & 0x07) + 1
+            ps2 = (cnf3 & 0x07) + 1
+            tqs = 1 + prop + ps1 + ps2
+
+            assert 5 <= tqs <= 25
+            assert 2 <= ps2 <= prop + ps1
+            assert crystal * 1e6 / (2 * (brp + 1) * tqs) == speed * 1e3
+
+
+def test_solve_rounded_speed():
+    '''
+    Test `solve` targets 33.3 Kb/s for the speed named 33.
+    '''
+    for crystal in (8, 16, 20):
+        cnf3, cnf2, cnf1 = solve(crystal, 33)
+        tqs = 4 + (cnf2 & 0x07) + ((cnf2 >> 3) & 0x07) + (cnf3 & 0x07)
+
+        assert crystal * 1e6 / (2 * (cnf1 + 1) * tqs) == approx(100000 / 3)
+
+
+def test_solve_unreachable():
+    '''
+    Test `solve` rejects the speed which needs less than 5 TQ per bit.
+    '''
+    assert solve(8, 1000) is None
+
+
+def test_table_is_up_to_date():
+    '''
+    Test the table in `mcpcan.py` matches the solver.
+    '''
+    path = os.path.join(os.path.dirname(pelican.__file__), 'mcpcan.py')
+    with open(path, 'r') as module:
+        assert generate() in module.read()
@@ -0,0 +1,44 @@
+from pytest import raises
+
+from pelican import capture
+
+
+def test_decode():
+    '''
+    Test `capture.decode` of standard and extended raw frames.
+    '''
+    std = capture.decode(b'\x24\x60\x00\x00\x02\x12\x34' + bytes(6) +
+                         b'\x00\x00\x01\x00')
+    ext = capture.decode(b'\xc7\xeb\x50\xe5\x40' + bytes(8) + bytes(4))
+
+    assert std == {'tm': 256, 'dlc': 2, 'data': b'\x12\x34' + bytes(6),
+                   'ext': False, 'id': 0x123, 'rtr': False}
+    assert ext['ext'] and ext['rtr']
+    assert ext['id'] == 0x18ff50e5
+
+
+def test_write_read(tmp_path):
+    '''
+    Test the capture file round trip.
+    '''
+    path = str(tmp_path / 'test.plcn')
+    frames = [{'host_tm': 1.5, 'id': 0x123, 'ext': False, 'rtr': False,
+               'dlc': 2, 'data': b'\x12\x34' + bytes(6), 'trigger': True},
+              {'host_tm': 2.5, 'id': 0x18ff50e5, 'ext': True, 'rtr': False,
+               'dlc': 8, 'data': b'abcdefgh', 'trigger': False}]
+
+    capture.write(path, frames[:1])
+    capture.write(path, frames[1:])
+
+    assert list(capture.read(path)) == frames
+
+
+def test_read_foreign_file(tmp_path):
+    '''
+    Test `capture.read` rejects other files.
+    '''
+    path = tmp_path / 'test.txt'
+    path.write_bytes(b'hello world, this is not a capture')
+
+    with raises(ValueError):
+        list(capture.read(str(path)))
@@ -0,0 +1,59 @@
+from pytest import approx, raises
+
+from pelican.clock import ClockSync, RESYNC_PERIOD, TICKS_PERIOD, ticks_diff
+
+
+def test_ticks_diff():
+    '''
+    Test `ticks_diff` across the wraparound.
+    '''
+    assert ticks_diff(10, 5) == 5
+    assert ticks_diff(5, 10) == -5
+    assert ticks_diff(3, TICKS_PERIOD - 2) == 5
+    assert ticks_diff(TICKS_PERIOD - 2, 3) == -5
+
+
+def test_clock_sync_offset_and_drift():
+    '''
+    Test `ClockSync` estimation with a board clock 50 ppm fast.
+    '''
+    sync = ClockSync()
+    start = 1600000000.0
+    for i in range(10):
+        host = start + i * 60
+        ticks = int((i * 60) * 1e6 * (1 + 50e-6) + 123) % TICKS_PERIOD
+        sync.add(host - 0.001, ticks, host + 0.001)
+
+    assert sync.drift == approx(50e-6, abs=1e-7)
+    # A frame received 1 s after the last ping, across the tick wraparound.
+    ticks = int((9 * 60 + 1) * 1e6 * (1 + 50e-6) + 123) % TICKS_PERIOD
+    assert sync.to_host(ticks) == approx(start + 9 * 60 + 1, abs=1e-4)
+
+
+def test_clock_sync_sessions():
+    '''
+    Test `ClockSync` estimates the drift from bursts of pings of separate
+    sessions, ignoring the pings delayed on the link.
+    '''
+    sync = ClockSync()
+    start = 1600000000.0
+    for session in range(3):
+        for i in range(8):
+            host = start + session * 20 + i * 0.005
+            ticks = int((host - start) * 1e6 * (1 - 30e-6))
+            sync.add(host - 0.001, ticks % TICKS_PERIOD, host + 0.001)
+        # Reply queued behind the frames, 40 ms late.
+        ticks = int((host + 0.02 - start) * 1e6 * (1 - 30e-6))
+        sync.add(host, ticks % TICKS_PERIOD, host + 0.08)
+
+    assert sync.drift == approx(-30e-6, abs=1e-6)
+    assert not sync.due(host + RESYNC_PERIOD / 2)
+    assert sync.due(host + 2 * RESYNC_PERIOD)
+
+
+def test_clock_sync_unsynchronized():
+    '''
+    Test `ClockSync.to_host` without any ping exchange.
+    '''
+    with raises(ValueError):
+        ClockSync().to_host(0)
@@ -0,0 +1,213 @@
+import queue
+import time
+from unittest import mock
+
+import pytest
+
+can = pytest.importorskip('can')
+
+from pelican import interface  # noqa: E402
+
+
+class FakeSerial():
+    '''
+    Serial port of the board running `CAN.serve`.
+    '''
+    def __init__(self, lines):
+        self.lines = queue.Queue()
+        for line in lines:
+            self.lines.put(line)
+        self.written = []
+        self.timeout = None
+
+    def readline(self):
+        try:
+            return self.lines.get(timeout=self.timeout)
+        except queue.Empty:
+            return b''
+
+    def read_until(self, expected):
+        return self.readline()
+
+    def write(self, data):
+        if data == b'P\n':
+            self.lines.put(b'P 5000\r\n')
+            return
+        self.written.append(data)
+
+    def reset_input_buffer(self):
+        pass
+
+
+def frame(can_id, data, tm):
+    '''
+    Raw Rx buffer of the standard frame with timestamp as hex.
+    '''
+    raw = bytes([can_id >> 3, (can_id << 5) & 0xE0, 0, 0, len(data)])
+    raw += data.ljust(8, b'\x00') + tm.to_bytes(4, 'big')
+    return raw.hex().encode()
+
+
+@pytest.fixture
+def bus_factory(monkeypatch):
+    '''
+    Builds `PelicanBus` on the fake board fed with the given lines.
+    '''
+    buses = []
+
+    def factory(lines, **kwargs):
+        board = mock.MagicMock()
+        board.serial = FakeSerial(lines)
+        monkeypatch.setattr(interface.pyboard, 'Pyboard',
+                            lambda *args, **kw: board)
+        monkeypatch.setattr(interface.Pelican, '_check_onboard_file',
+                            lambda self: None)
+        monkeypatch.setattr(interface.Pelican, '_sync_clock',
+                            lambda self: self.clock.add(time.time(), 0,
+                                                        time.time()))
+        bus = interface.PelicanBus('/dev/ttyUSB0', **kwargs)
+        buses.append(bus)
+        return bus, board
+
+    yield factory
+    for bus in buses:
+        bus.shutdown()
+
+
+def test_hardware_filter():
+    '''
+    Test the python-can filters map to the MCP2515 registers.
+    '''
+    assert interface.hardware_filter(None) == (None, True)
+
+    flt, exact = interface.hardware_filter([
+        {'can_id': 0x123, 'can_mask': 0x7FF, 'extended': False},
+        {'can_id': 0x456, 'can_mask': 0x7FF, 'extended': False}])
+    assert exact
+    assert flt == {'F0': b'\x24\x60\x00\x00', 'F1': b'\x8a\xc0\x00\x00',
+                   'M0': b'\xff\xe0\x00\x00'}
+
+    flt, exact = interface.hardware_filter([
+        {'can_id': 0x18ff50e5, 'can_mask': 0x1FFFFFFF, 'extended': True}])
+    assert exact
+    assert flt['F0'] == b'\xc7\xeb\x50\xe5'
+    assert flt['M0'] == b'\xff\xe3\xff\xff'
+
+    flt, exact = interface.hardware_filter([
+        {'can_id': 0x100, 'can_mask': 0x7FF, 'extended': False},
+        {'can_id': 0x101, 'can_mask': 0x7FF, 'extended': False},
+        {'can_id': 0x103, 'can_mask': 0x7FF, 'extended': False}])
+    assert not exact
+    assert flt['M0'] == b'\xff\x80\x00\x00'
+
+    assert interface.hardware_filter([
+        {'can_id': 0x100, 'can_mask': 0x7FF, 'extended': False},
+        {'can_id': 0x100, 'can_mask': 0x7FF, 'extended': True}]) == \
+        (None, False)
+
+
+def test_recv_and_send(bus_factory):
+    '''
+    Test `PelicanBus` receives the batched frames and sends messages.
+    '''
+    bus, board = bus_factory([
+        b'R' + frame(0x123, b'\x01\x02', 1000) + frame(0x456, b'', 2000) +
+        b'\r\n'])
+
+    first = bus.recv(timeout=1)
+    second = bus.recv(timeout=1)
+    assert first.arbitration_id == 0x123
+    assert first.data == b'\x01\x02'
+    assert first.timestamp == pytest.approx(time.time(), abs=1)
+    assert second.timestamp - first.timestamp == \
+        pytest.approx(0.001, abs=1e-6)
+    assert second.arbitration_id == 0x456
+    assert second.dlc == 0
+    assert bus.recv(timeout=0.01) is None
+    board.exec_raw_no_follow.assert_called_with('can.serve(16, 5)')
+
+    bus.send(can.Message(arbitration_id=0x18ff50e5, data=b'\xab',
+                         is_extended_id=True))
+    assert board.serial.written == [b'T18ff50e50101ab\n']
+
+
+def test_queue_bounded(bus_factory):
+    '''
+    Test `PelicanBus` keeps the latest frames when the queue is full.
+    '''
+    batch = b''.join(frame(i, b'', i) for i in range(5))
+    bus, _ = bus_factory([b'R' + batch + b'\r\n'], queue_size=3)
+
+    deadline = time.monotonic() + 1
+    while bus.dropped < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert bus.dropped == 2
+    assert [bus.recv(timeout=1).arbitration_id for _ in range(3)] == \
+        [2, 3, 4]
+
+
+def test_queue_race(bus_factory):
+    '''
+    Test `PelicanBus` survives `recv` taking the oldest frame of the full
+    queue first.
+    '''
+    bus, _ = bus_factory([], queue_size=1)
+    bus._put('oldest')
+    get_nowait = bus._queue.get_nowait
+    races = [queue.Empty]
+
+    def taken_meanwhile():
+        if races:
+            raise races.pop()
+        return get_nowait()
+    bus._queue.get_nowait = taken_meanwhile
+
+    bus._put('latest')
+
+    assert bus._queue.get_nowait() == 'latest'
+    assert bus.dropped == 1
+
+
+def test_corrupted_line(bus_factory, caplog):
+    '''
+    Test `PelicanBus` drops the corrupted line and keeps receiving.
+    '''
+    bus, _ = bus_factory([b'R24600xx\r\n',
+                          b'R' + frame(0x123, b'', 1000) + b'\r\n'])
+
+    assert bus.recv(timeout=1).arbitration_id == 0x123
+    assert 'corrupted' in caplog.text
+
+
+def test_session_end(bus_factory):
+    '''
+    Test `PelicanBus` fails once the session on the board ends.
+    '''
+    bus, _ = bus_factory([b'R' + frame(0x123, b'', 1000) + b'\r\n',
+                          b'\x04Traceback (most recent call last):\r\n',
+                          b'MemoryError: \r\n\x04>'])
+
+    assert bus.recv(timeout=1).arbitration_id == 0x123
+    with pytest.raises(can.CanOperationError, match='MemoryError'):
+        bus.recv(timeout=1)
+    with pytest.raises(can.CanOperationError):
+        bus.recv(timeout=0)
+    with pytest.raises(can.CanOperationError):
+        bus.send(can.Message(arbitration_id=0x123))
+
+
+def test_resync(bus_factory):
+    '''
+    Test `PelicanBus` pings the board clock during the session.
+    '''
+    bus, _ = bus_factory([])
+    clock = bus._pelican.clock
+    samples = len(clock._samples)
+    clock.due = lambda now: True
+
+    deadline = time.monotonic() + 1
+    while len(clock._samples) == samples and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert len(clock._samples) > samples
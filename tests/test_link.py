@@ -0,0 +1,199 @@
+import ast
+import itertools
+import re
+import types
+
+from ampy.pyboard import PyboardError
+from pytest import approx, fixture, raises
+
+from pelican import link as link_module
+from pelican.link import Link, MAX_CHUNK, MIN_CHUNK
+
+
+class FakeBoard():
+    '''
+    Board which loses the commands longer than `limit` bytes.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.file = bytearray()
+        self.serial = type('Serial', (), {'baudrate': 115200})()
+
+    def enter_raw_repl(self):
+        pass
+
+    def exit_raw_repl(self):
+        pass
+
+    def exec(self, line):
+        if len(line) > self.limit:
+            raise PyboardError('could not exec command')
+        if line.startswith('print(f.write('):
+            chunk = ast.literal_eval(line[len('print(f.write('):-2])
+            self.file.extend(chunk)
+            return b'%d\r\n' % len(chunk)
+        if line.startswith('f.seek('):
+            del self.file[int(line[len('f.seek('):-1]):]
+        if line.startswith('for i in range('):
+            return b'0' * 34 + b'\r\n'
+        return b''
+
+
+def test_put_adapts_chunk():
+    '''
+    Test `Link.put` shrinks the chunk to what the board keeps up with.
+    '''
+    board = FakeBoard(limit=700)
+    link = Link(board)
+    data = bytes(range(256)) * 40
+
+    link.put('file', data)
+
+    assert bytes(board.file) == data
+    assert MIN_CHUNK < link.chunk < MAX_CHUNK
+
+
+def test_put_fails():
+    '''
+    Test `Link.put` gives up when even the smallest chunk is lost.
+    '''
+    link = Link(FakeBoard(limit=10))
+
+    with raises(PyboardError):
+        link.put('file', b'data')
+
+
+def test_test_report():
+    '''
+    Test `Link.test` throughput report with a deterministic clock.
+    '''
+    clock = itertools.count(0.0, 0.5)
+    link = Link(FakeBoard(limit=10000), clock=lambda: next(clock))
+
+    res = link.test(size=1000, frames=10)
+
+    assert res['baudrate'] == 115200
+    assert res['tx_bytes_per_sec'] == 2000
+    assert res['rx_bytes_per_sec'] == 72
+    assert res['frames_per_sec'] == 20
+
+
+def test_test_excludes_reboot():
+    '''
+    Test `Link.test` does not count the soft reboot as write time.
+    '''
+    class SlowBoard(FakeBoard):
+        now = 0.0
+
+        def enter_raw_repl(self):
+            self.now += 0.7
+
+        def exec(self, line):
+            self.now += 0.001
+            return super().exec(line)
+
+    board = SlowBoard(limit=10000)
+    link = Link(board, clock=lambda: board.now)
+
+    res = link.test(size=1024, frames=10)
+
+    # 32 + 64 + 128 + 256 + 512 + 32 bytes in six writes.
+    assert res['tx_bytes_per_sec'] == approx(1024 / 0.006)
+
+
+class RateBoard():
+    '''
+    Board switching its UART as told, up to `max_rate`, with the fallback
+    timer; `keeps_rate` tells whether the rate survives the soft reboot.
+    '''
+    def __init__(self, max_rate, keeps_rate=True):
+        self.rate = 115200
+        self.default = 115200
+        self.max_rate = max_rate
+        self.keeps_rate = keeps_rate
+        self.revert = None
+        self.reply = b''
+        self.serial = types.SimpleNamespace(
+            baudrate=115200, timeout=1, reset_input_buffer=lambda: None,
+            write=self._write, read=lambda n: self.reply[:n])
+
+    def _in_sync(self):
+        return self.serial.baudrate == self.rate <= self.max_rate
+
+    def _write(self, data):
+        self.reply = b'OK' if self._in_sync() else b'\xfe'
+        if self._in_sync() and data.startswith(b'_pl_t.deinit()'):
+            self.revert = None
+
+    def tick(self):
+        '''
+        The fallback timer fires.
+        '''
+        if self.revert is not None:
+            self.rate, self.revert = self.revert, None
+
+    def enter_raw_repl(self):
+        if not self._in_sync():
+            raise PyboardError('could not enter raw repl')
+        if not self.keeps_rate:
+            self.rate = self.default
+        if not self._in_sync():
+            raise PyboardError('could not enter raw repl')
+
+    def exit_raw_repl(self):
+        pass
+
+    def exec(self, line):
+        return b''
+
+    def exec_raw_no_follow(self, line):
+        uart = re.findall(r'UART\(\d+, (\d+)\)', line)
+        if 'Timer.ONE_SHOT' in line:
+            self.revert = int(uart[0])
+        self.rate = int(uart[-1])
+
+    def follow(self, timeout):
+        return b'', b''
+
+
+@fixture
+def board_time(monkeypatch):
+    '''
+    Makes the waits of `Link` instant, letting the board timers fire.
+    '''
+    boards = []
+    monkeypatch.setattr(link_module, 'time', types.SimpleNamespace(
+        sleep=lambda s: [board.tick() for board in boards
+                         if s * 1000 >= link_module.REVERT_MS]))
+    return boards
+
+
+def test_negotiate_confirm_fails(board_time):
+    '''
+    Test `Link.negotiate` falls back when the new rate is not confirmed
+    and takes the next one.
+    '''
+    board = RateBoard(max_rate=460800)
+    board_time.append(board)
+    link = Link(board)
+
+    assert link.negotiate((921600, 460800)) == 460800
+    assert board.rate == board.serial.baudrate == 460800
+
+    link.restore()
+    assert board.rate == board.serial.baudrate == 115200
+
+
+def test_negotiate_reboot_fails(board_time):
+    '''
+    Test `Link.negotiate` stays at the original rate when the board loses
+    the new one over the soft reboot.
+    '''
+    board = RateBoard(max_rate=921600, keeps_rate=False)
+    board_time.append(board)
+    link = Link(board)
+
+    assert link.negotiate((921600, )) == 115200
+    assert board.rate == board.serial.baudrate == 115200
+    link.restore()
+    assert board.rate == 115200
@@ -0,0 +1,415 @@
+import io
+import itertools
+import sys
+import types
+
+from pytest import raises
+
+
+def test_loopback(chip):
+    '''
+    Test `CAN.start` in loopback mode receives own messages.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8, loopback=True)
+
+    can.send_msg({'id': 0x18ff50e5, 'ext': True, 'data': b'\x12\x34',
+                  'dlc': 2, 'rtr': False})
+    msg = can.recv_msg()
+
+    assert chip.mode == 0x40
+    assert msg['id'] == 0x18ff50e5
+    assert msg['ext']
+    assert msg['dlc'] == 2
+    assert msg['data'][:2] == b'\x12\x34'
+
+
+def test_stress(chip):
+    '''
+    Test `CAN.stress` against the emulator in loopback mode.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8, loopback=True)
+
+    res = can.stress(count=300, ids=(0x100, 0x7FF, 0x1ABCDEF),
+                     dlcs=(0, 4, 8))
+
+    assert res['sent'] == 300
+    assert res['received'] == 300
+    assert res['lost'] == 0
+    assert res['reordered'] == 0
+    assert res['fps'] > 0
+    assert 0 < res['p50'] <= res['p90'] <= res['p99'] <= res['p100']
+
+
+def test_stress_loss(chip):
+    '''
+    Test `CAN.stress` counts the messages which never come back.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8, loopback=True)
+    receive = chip.receive
+    sent = []
+
+    def lossy(frame):
+        sent.append(frame)
+        if len(sent) % 10:
+            receive(frame)
+    chip.receive = lossy
+
+    res = can.stress(count=100, timeout_ms=10)
+
+    assert res['received'] == 90
+    assert res['lost'] == 10
+
+
+def frame(can_id, data):
+    '''
+    Raw standard frame as it is in the Rx buffer.
+    '''
+    head = bytes([can_id >> 3, (can_id << 5) & 0xE0, 0, 0, len(data)])
+    return head + data + bytes(8 - len(data))
+
+
+def test_capture(chip):
+    '''
+    Test `CAN.capture` keeps the window around the trigger frame.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+    frames = iter([frame(0x100 + i, bytes([i])) for i in range(20)] +
+                  [frame(0x7E8, b'\x03\x7f')] +
+                  [frame(0x200 + i, bytes([i])) for i in range(20)])
+
+    def check_rx():
+        for dat in itertools.islice(frames, 2):
+            chip.receive(dat)
+        return chip.mcpcan.CAN.check_rx(can)
+    can.check_rx = check_rx
+
+    window, index = can.capture(pre=5, post=3,
+                                trigger={'id': 0x7E8, 'mask': b'\xff\xff',
+                                         'value': b'\x03\x7f'})
+
+    msgs = [can._decode(window[i:i + 17]) for i in range(0, len(window), 17)]
+    assert [msg['id'] for msg in msgs] == (
+        [0x100 + i for i in range(15, 20)] + [0x7E8] +
+        [0x200 + i for i in range(3)])
+    assert index == 5
+
+
+def test_capture_trigger_ext(chip):
+    '''
+    Test `CAN.capture` tells the standard and extended trigger ids apart.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+    ext = bytes([0x00, 0x08, 0x01, 0x23, 0x01, 0x01]) + bytes(7)
+    chip.feed(ext, frame(0x123, b'\x02'))
+
+    window, index = can.capture(pre=5, post=0,
+                                trigger={'id': 0x123, 'ext': False})
+
+    assert index == 1
+    assert can._decode(window[17:34])['ext'] is False
+
+
+def test_capture_timeout(chip):
+    '''
+    Test `CAN.capture` gives up without the trigger.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+
+    assert can.capture(trigger={'id': 1}, timeout_ms=5) is None
+
+
+def test_capture_quiet_after_trigger(chip):
+    '''
+    Test `CAN.capture` returns the partial window when the bus goes quiet
+    after the trigger.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+    chip.feed(frame(0x100, b'\x01'), frame(0x7E8, b'\x02'),
+              frame(0x101, b'\x03'))
+
+    window, index = can.capture(pre=5, post=3, trigger={'id': 0x7E8},
+                                timeout_ms=100, post_ms=100)
+
+    assert len(window) == 3 * 17
+    assert can._decode(window[index * 17:(index + 1) * 17])['id'] == 0x7E8
+
+
+def test_reducer(chip):
+    '''
+    Test `Reducer` forwards changed payloads and keeps the rate limits.
+    '''
+    chip.clock.step_us = 0
+    reducer = chip.mcpcan.Reducer(change_only=True, rate_limits={0x200: 10})
+
+    assert reducer.forward(frame(0x100, b'\x01'))
+    assert not reducer.forward(frame(0x100, b'\x01'))
+    assert not reducer.forward(frame(0x100, b'\x01'))
+    assert reducer.forward(frame(0x100, b'\x02'))
+    assert reducer.forward(frame(0x200, b'\x01'))
+    assert not reducer.forward(frame(0x200, b'\x02'))
+    chip.clock.sleep_ms(100)
+    assert reducer.forward(frame(0x200, b'\x03'))
+
+    assert reducer.summary() == {0x100: 2, 0x200: 1}
+    assert reducer.summary() == {}
+
+
+def test_reducer_dlc(chip):
+    '''
+    Test `Reducer` compares only the data bytes covered by DLC and keeps
+    extended ids apart by bit 29.
+    '''
+    reducer = chip.mcpcan.Reducer()
+    short = frame(0x100, b'\x01')
+    leftover = bytearray(short)
+    leftover[6] = 0xFF  # Past DLC, left over from a longer message.
+    sidl = (0x18ff50e5 >> 13) & 0xE0 | 0x08 | (0x18ff50e5 >> 16) & 0x03
+    ext = bytes([0x18ff50e5 >> 21, sidl, 0x50, 0xe5, 1, 0x01]) + bytes(7)
+
+    assert reducer.forward(short)
+    assert not reducer.forward(bytes(leftover))
+    assert reducer.forward(ext)
+    assert not reducer.forward(ext)
+
+    assert reducer.summary() == {0x100: 1, 0x20000000 | 0x18ff50e5: 1}
+
+
+def test_reducer_full_table(chip):
+    '''
+    Test `Reducer` forwards the ids over its table.
+    '''
+    reducer = chip.mcpcan.Reducer(max_ids=1)
+
+    assert reducer.forward(frame(0x100, b'\x01'))
+    assert reducer.forward(frame(0x101, b'\x01'))
+    assert reducer.forward(frame(0x101, b'\x01'))
+    assert not reducer.forward(frame(0x100, b'\x01'))
+
+
+def host_input(monkeypatch, text, interrupt=None):
+    '''
+    Feeds `text` to the stdin of the board, polled with `select`.
+    Ctrl-C comes after `interrupt` polls of the drained input.
+    '''
+    stdin = io.StringIO(text)
+    polls = itertools.count()
+
+    class Poll():
+        def register(self, *args):
+            pass
+
+        def poll(self, timeout):
+            if stdin.tell() < len(stdin.getvalue()):
+                return [(0, 1)]
+            if interrupt is not None and next(polls) > interrupt:
+                raise KeyboardInterrupt
+            return []
+
+    select = types.ModuleType('select')
+    select.POLLIN = 1
+    select.poll = Poll
+    monkeypatch.setitem(sys.modules, 'select', select)
+    monkeypatch.setattr(sys, 'stdin', stdin)
+
+
+def test_stream(chip, monkeypatch, capsys):
+    '''
+    Test `CAN.stream` prints the forwarded frames, the summary and answers
+    the clock pings.
+    '''
+    host_input(monkeypatch, 'P')
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8, loopback=True)
+    for _ in range(3):
+        can.send_msg({'id': 0x123, 'ext': False, 'data': b'\x01',
+                      'dlc': 1, 'rtr': False})
+        can.check_rx()
+
+    can._rx_buf, buf = [], can._rx_buf
+    can.check_rx = lambda: can._rx_buf.extend(buf) or buf.clear()
+    can.stream(duration_ms=1, reducer=chip.mcpcan.Reducer())
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 3
+    assert lines[0].startswith('P ') and int(lines[0][2:]) > 0
+    assert lines[1].startswith('2460000001')
+    assert lines[2] == 'S {291: 2}'
+
+
+def test_serve(chip, monkeypatch, capsys):
+    '''
+    Test `CAN.serve` sends the host messages, batches the received ones
+    and answers the clock pings.
+    '''
+    host_input(monkeypatch, 'T000001230003020304\nP\nT000001230003020506\n',
+               interrupt=50)
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8, loopback=True)
+
+    with raises(KeyboardInterrupt):
+        can.serve(batch=2, batch_ms=1000)
+
+    out = capsys.readouterr().out.splitlines()
+    assert len(out) == 2
+    assert out[0].startswith('P ')
+    window = bytes.fromhex(out[1][1:])
+    assert out[1][0] == 'R' and len(window) == 2 * 17
+    assert window[4:8] == b'\x03\x02\x03\x04'
+    assert window[21:25] == b'\x03\x02\x05\x06'
+
+
+def test_request(chip):
+    '''
+    Test `CAN.request` finds the response on a busy bus and keeps only
+    the latest unrelated messages.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+    sidl = (0x18daf110 >> 13) & 0xE0 | 0x08 | (0x18daf110 >> 16) & 0x03
+    response = bytes([0x18daf110 >> 21, sidl, 0xf1, 0x10, 3, 0x41, 0x0d,
+                      0x32])
+    chip.on_tx = lambda tx: chip.feed(
+        *[frame(0x100 + i, b'\x00') for i in range(40)], response)
+
+    msg = can.request({'id': 0x18db33f1, 'ext': True, 'data': b'\x02\x01\x0d',
+                       'dlc': 3, 'rtr': False}, 0x18daf110)
+
+    assert msg['id'] == 0x18daf110
+    assert msg['data'][:3] == b'\x41\x0d\x32'
+    assert len(can._rx_buf) == chip.mcpcan.RX_KEEP
+    assert can.recv_msg()['id'] == 0x100 + 40 - chip.mcpcan.RX_KEEP
+
+
+def test_request_many(chip):
+    '''
+    Test `CAN.request_many` collects the responses of all the requests.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+
+    def respond(tx):
+        can_id = (tx[0] << 3) | (tx[1] >> 5)
+        if can_id != 0x7E2:
+            chip.feed(frame(can_id + 8, bytes([can_id & 0xFF])))
+    chip.on_tx = respond
+
+    res = can.request_many(
+        [{'id': i, 'ext': False, 'data': b'\x00', 'dlc': 1, 'rtr': False}
+         for i in (0x7E0, 0x7E1, 0x7E2)], [0x7E8, 0x7E9, 0x7EA], 100)
+
+    assert [msg['id'] for msg in res] == [0x7E8, 0x7E9]
+
+
+def test_isotp_send(chip):
+    '''
+    Test `IsoTp.send` follows the flow control: Wait, block size and
+    separation time.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+    data = bytes(range(40))
+    received = bytearray()
+    times = []
+
+    def receiver(tx):
+        pci = tx[5] >> 4
+        if pci == 1:
+            received.extend(tx[7:13])
+            chip.feed(frame(0x7E8, b'\x31\x00\x00'),
+                      frame(0x7E8, b'\x30\x02\x05'))
+        elif pci == 2:
+            received.extend(tx[6:13])
+            times.append(chip.clock.us)
+            if len(times) % 2 == 0:
+                chip.feed(frame(0x7E8, b'\x30\x02\x05'))
+    chip.on_tx = receiver
+
+    chip.mcpcan.IsoTp(can, 0x7E0, 0x7E8).send(data)
+
+    assert bytes(received[:len(data)]) == data
+    assert len(times) == 5
+    assert times[1] - times[0] >= 5000
+
+
+def test_isotp_send_overflow(chip):
+    '''
+    Test `IsoTp.send` stops when the receiver reports overflow.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+    chip.on_tx = lambda tx: chip.feed(frame(0x7E8, b'\x32\x00\x00'))
+
+    with raises(OSError):
+        chip.mcpcan.IsoTp(can, 0x7E0, 0x7E8).send(bytes(20))
+
+
+def test_isotp_send_too_long(chip):
+    '''
+    Test `IsoTp.send` rejects the data the First Frame cannot declare.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+    sent = []
+    chip.on_tx = sent.append
+
+    with raises(ValueError):
+        chip.mcpcan.IsoTp(can, 0x7E0, 0x7E8).send(bytes(4096))
+    assert sent == []
+
+
+def test_isotp_recv(chip):
+    '''
+    Test `IsoTp.recv` offers the block size and sends no flow control
+    after the last block.
+    '''
+    can = chip.mcpcan.CAN()
+    can.start(speed_cfg=500, crystal=8)
+    data = bytes(range(34))
+    cfs = [frame(0x7E8, bytes([0x20 | sn]) + data[7 * sn - 1:7 * sn + 6])
+           for sn in range(1, 5)]
+    fcs = []
+
+    def sender(tx):
+        fcs.append(bytes(tx[5:8]))
+        chip.feed(*cfs[:2])
+        del cfs[:2]
+    chip.on_tx = sender
+    chip.feed(frame(0x7E8, b'\x10\x22' + data[:6]))
+
+    tp = chip.mcpcan.IsoTp(can, 0x7E0, 0x7E8, block_size=2)
+
+    assert tp.recv() == data
+    assert fcs == [b'\x30\x02\x00'] * 2
+
+
+def test_autobaud(chip):
+    '''
+    Test `CAN.autobaud` rejects the speeds with error flags and picks the
+    first one with clean frames.
+    '''
+    speeds = {cfg: speed for speed, cfg in chip.mcpcan.CNF[8].items()}
+    select = chip.select
+
+    def bus():
+        speed = speeds.get(bytes(chip.regs[0x28:0x2B]))
+        if chip.mode == 0x60:
+            if speed in (500, 125) and not chip.regs[0x2C] & 0x01:
+                chip.receive(frame(0x123, b'\x01'))
+            if speed == 500:
+                chip.regs[0x2D] |= 0x02  # EFLG: RX error warning
+            elif speed == 250:
+                chip.regs[0x2C] |= 0x80  # MERRF
+        select()
+    chip.select = bus
+    can = chip.mcpcan.CAN()
+
+    assert can.autobaud(8, window_ms=20) == 125
+    assert chip.mode == 0x60
+    assert can.autobaud(8, speeds=(500, 250), window_ms=20) is None
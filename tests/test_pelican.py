@@ -1,7 +1,14 @@
+import base64
+import io
 import os
+import time
 from unittest.mock import patch
 
+from ampy.pyboard import PyboardError
+from pytest import approx, raises
+
 import pelican
+from pelican.clock import TICKS_PERIOD
 from pelican.pelican import Pelican
 
 
@@ -9,6 +16,31 @@ _board = patch("ampy.pyboard.Pyboard")
 instance = Pelican(_board)
 
 
+class StreamSerial():
+    '''
+    Serial port of the board streaming `output`.
+    '''
+    def __init__(self, output):
+        self.output = io.BytesIO(output)
+        self.written = []
+        self.timeout = None
+
+    def readline(self):
+        return self.output.readline()
+
+    def read_until(self, expected):
+        data = b''
+        while not data.endswith(expected):
+            byte = self.output.read(1)
+            if not byte:
+                break
+            data += byte
+        return data
+
+    def write(self, data):
+        self.written.append(data)
+
+
 @patch('builtins.open', autospec=True)
 @patch('yaml.load')
 def test__read_config(yaml, opn):
@@ -23,7 +55,7 @@ def test__read_config(yaml, opn):
 
 @patch('builtins.open', autospec=True)
 @patch('builtins.print', autospec=True)
-@patch('ampy.files.Files.put', autospec=True)
+@patch('pelican.link.Link.put', autospec=True)
 @patch('ampy.files.Files.ls', autospec=True)
 def test__check_onboard_file(ls, put, prnt, opn):
     '''
@@ -56,14 +88,23 @@ def test_dump(config, check, pyboard):
         'l': 1
     }
 
+    def exec(line):
+        if line == 'print(res)':
+            return b"{'tm': 1000500, 'id': 291, 'data': b'Hello'}\r\n"
+        return b'1000000\r\n'
+    pyboard.exec.side_effect = exec
+
     instance = Pelican(pyboard)
-    instance.dump('file')
+    frame = instance.dump('file')
 
     check.assert_called_once()
     config.assert_called_once()
     pyboard.enter_raw_repl.assert_called_once()
     pyboard.exec.assert_called()
     pyboard.exit_raw_repl.assert_called_once()
+    assert frame['id'] == 291
+    assert frame['data'] == b'Hello'
+    assert 'host_tm' in frame
 
 
 @patch("ampy.pyboard.Pyboard")
@@ -102,3 +143,184 @@ def test_blink(pyboard):
     pyboard.enter_raw_repl.assert_called_once()
     pyboard.exec.assert_called()
     pyboard.exit_raw_repl.assert_called_once()
+
+
+@patch("ampy.pyboard.Pyboard")
+@patch('pelican.pelican.Pelican._check_onboard_file', autospec=True)
+@patch('pelican.pelican.Pelican._read_config', autospec=True)
+def test_request_many(config, check, pyboard):
+    '''
+    Test `Pelican.request_many` matches the responses to the requests.
+    '''
+    config.return_value = {
+        'cs': 1,
+        'speed': 1,
+        'crystal': 1,
+        'filter': 1,
+        'l': 1
+    }
+
+    def exec(line):
+        if line == 'print(res)':
+            return b"[{'tm': 3, 'id': 2, 'data': b'b'}, \
+{'tm': 4, 'id': 1, 'data': b'a'}]\r\n"
+        return b'1000000\r\n'
+    pyboard.exec.side_effect = exec
+    pyboard.exec_raw.side_effect = lambda line, timeout: (exec(line), b'')
+
+    instance = Pelican(pyboard)
+    frames = instance.request_many([({'id': 0x10}, 1),
+                                    ({'id': 0x20}, 2),
+                                    ({'id': 0x30}, 3)], 'file')
+
+    pyboard.enter_raw_repl.assert_called_once()
+    pyboard.exit_raw_repl.assert_called_once()
+    assert frames[0]['data'] == b'a'
+    assert frames[1]['data'] == b'b'
+    assert frames[2] is None
+
+
+@patch("ampy.pyboard.Pyboard")
+@patch('pelican.pelican.Pelican._check_onboard_file', autospec=True)
+@patch('pelican.pelican.Pelican._read_config', autospec=True)
+def test_capture(config, check, pyboard):
+    '''
+    Test `Pelican.capture` unwraps the window older than the tick period.
+    '''
+    config.return_value = {
+        'cs': 1,
+        'speed': 1,
+        'crystal': 1,
+        'filter': 1,
+        'l': 1
+    }
+    # Frames 400 s apart, the newest 0.1 s before the ping.
+    ticks = [(900000 - i * 400000000) % TICKS_PERIOD for i in (2, 1, 0)]
+    window = b''.join(bytes(13) + tm.to_bytes(4, 'big') for tm in ticks)
+    res = repr((base64.b64encode(window) + b'\n', 1)).encode()
+    pyboard.exec.return_value = b'1000000\r\n'
+    pyboard.exec_raw.side_effect = lambda line, timeout: (
+        res + b'\r\n' if line.startswith('print(') else b'', b'')
+
+    frames = Pelican(pyboard).capture('file', {'id': 0})
+
+    assert [frame['trigger'] for frame in frames] == [False, True, False]
+    assert frames[2]['host_tm'] == approx(time.time() - 0.1, abs=1)
+    assert frames[2]['host_tm'] - frames[1]['host_tm'] == approx(400)
+    assert frames[1]['host_tm'] - frames[0]['host_tm'] == approx(400)
+
+
+@patch("ampy.pyboard.Pyboard")
+@patch('pelican.pelican.Pelican._check_onboard_file', autospec=True)
+@patch('pelican.pelican.Pelican._read_config', autospec=True)
+def test_monitor(config, check, pyboard):
+    '''
+    Test `Pelican.monitor` parses the streamed frames and summaries.
+    '''
+    config.return_value = {
+        'cs': 1,
+        'speed': 1,
+        'crystal': 1,
+        'filter': 1,
+        'l': 1
+    }
+    pyboard.exec.return_value = b'1000000\r\n'
+    pyboard.serial = StreamSerial(b'24600000021234000000000000000f4240\r\n'
+                                  b'S {291: 5, 805306367: 1}\r\n'
+                                  b'P 2000000\r\n\x04\x04>')
+
+    frames = []
+    summaries = []
+    instance = Pelican(pyboard)
+    instance.clock.due = lambda now: True
+    instance.monitor('file', frames.append, summaries.append, duration=1,
+                     change_only=True)
+
+    pyboard.enter_raw_repl.assert_called_once()
+    pyboard.exit_raw_repl.assert_called_once()
+    assert len(frames) == 1
+    assert frames[0]['id'] == 0x123
+    assert frames[0]['data'][:2] == b'\x12\x34'
+    assert 'host_tm' in frames[0]
+    assert summaries == [{(0x123, False): 5, (0x0FFFFFFF, True): 1}]
+    # Pinged in band after the first line.
+    assert pyboard.serial.written[0] == b'P'
+    assert len(instance.clock._samples) == 9
+    pyboard.exec_raw.assert_not_called()
+    assert pyboard.serial.timeout is None
+
+
+@patch("ampy.pyboard.Pyboard")
+@patch('pelican.pelican.Pelican._check_onboard_file', autospec=True)
+@patch('pelican.pelican.Pelican._read_config', autospec=True)
+def test_monitor_long(config, check, pyboard):
+    '''
+    Test `Pelican.monitor` keeps up with the long stream.
+    '''
+    config.return_value = {
+        'cs': 1,
+        'speed': 1,
+        'crystal': 1,
+        'filter': 1,
+        'l': 1
+    }
+    pyboard.exec.return_value = b'1000000\r\n'
+    line = b'24600000021234000000000000000f4240\r\n'
+    pyboard.serial = StreamSerial(line * 25000 + b'\x04\x04>')
+
+    frames = []
+    Pelican(pyboard).monitor('file', frames.append)
+
+    assert len(frames) == 25000
+
+
+@patch("ampy.pyboard.Pyboard")
+@patch('pelican.pelican.Pelican._check_onboard_file', autospec=True)
+@patch('pelican.pelican.Pelican._read_config', autospec=True)
+def test_monitor_error(config, check, pyboard):
+    '''
+    Test `Pelican.monitor` raises the exception of the board.
+    '''
+    config.return_value = {
+        'cs': 1,
+        'speed': 1,
+        'crystal': 1,
+        'filter': 1,
+        'l': 1
+    }
+    pyboard.exec.return_value = b'1000000\r\n'
+    pyboard.serial = StreamSerial(b'\x04Traceback (most recent call last):\r\n'
+                                  b'MemoryError: \r\n\x04>')
+
+    with raises(PyboardError):
+        Pelican(pyboard).monitor('file', print)
+    pyboard.exit_raw_repl.assert_called_once()
+
+
+@patch("ampy.pyboard.Pyboard")
+@patch('pelican.pelican.Pelican._check_onboard_file', autospec=True)
+@patch('pelican.pelican.Pelican._read_config', autospec=True)
+def test_stress(config, check, pyboard):
+    '''
+    Test `Pelican.stress` starts the CAN in loopback mode.
+    '''
+    config.return_value = {
+        'cs': 1,
+        'speed': 500,
+        'crystal': 8,
+        'filter': None,
+        'l': False
+    }
+    lines = []
+
+    def exec_raw(line, timeout):
+        lines.append(line)
+        return b"{'lost': 0}\r\n", b''
+    pyboard.exec_raw.side_effect = exec_raw
+
+    res = Pelican(pyboard).stress('file', count=1000, rate=50)
+
+    assert res == {'lost': 0}
+    assert 'can.start(speed_cfg=500, crystal=8, filter=None, ' \
+        'listen_only=False, loopback=True)' in lines
+    assert pyboard.exec_raw.call_args[0][1] == 30
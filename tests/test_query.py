@@ -0,0 +1,46 @@
+from pelican import capture, query
+
+
+def frames():
+    '''
+    One frame per second cycling through three ids.
+    '''
+    for i in range(300):
+        yield {'host_tm': 1000.0 + i, 'id': 0x100 + i % 3, 'ext': False,
+               'rtr': False, 'dlc': 2, 'data': bytes([i % 3, i % 256]) +
+               bytes(6)}
+
+
+def test_run(tmp_path):
+    '''
+    Test `query.run` over several record aligned chunks in parallel.
+    '''
+    path = str(tmp_path / 'test.plcn')
+    capture.write(path, frames())
+
+    res = query.run([path], query.Query(ids=[0x101]), workers=2, limit=3,
+                    chunk=64)
+
+    assert res['count'] == 100
+    assert res['first']['host_tm'] == 1001.0
+    assert res['last']['host_tm'] == 1298.0
+    assert res['rate'] == 99 / 297
+    assert [frame['host_tm'] for frame in res['frames']] == [1001.0, 1004.0,
+                                                             1007.0]
+
+
+def test_run_predicates(tmp_path):
+    '''
+    Test `query.run` data mask and time range predicates.
+    '''
+    path = str(tmp_path / 'test.plcn')
+    capture.write(path, frames())
+
+    res = query.run([path, path],
+                    query.Query(data=b'\x02\x00', mask=b'\xff\x01',
+                                start=1100.0, end=1200.0), workers=1)
+
+    # Frames 101..199 with i % 3 == 2 and even i, twice.
+    assert res['count'] == 2 * len([i for i in range(100, 200)
+                                    if i % 3 == 2 and i % 2 == 0])
+    assert res['frames'] == []
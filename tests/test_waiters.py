@@ -0,0 +1,32 @@
+from pelican.waiters import Waiters
+
+
+def test_waiters_dispatch():
+    '''
+    Test `Waiters.dispatch` resolves the requests with the same id in order.
+    '''
+    waiters = Waiters()
+    first = waiters.register(0x7E8)
+    second = waiters.register(0x7E8)
+    other = waiters.register(0x7E9)
+
+    assert waiters.dispatch({'id': 0x7E8, 'data': b'1'})
+    assert waiters.dispatch({'id': 0x7E8, 'data': b'2'})
+    assert not waiters.dispatch({'id': 0x7E8, 'data': b'3'})
+
+    assert first.wait(0)['data'] == b'1'
+    assert second.wait(0)['data'] == b'2'
+    assert other.wait(0) is None
+    assert len(waiters) == 1
+
+
+def test_waiters_cancel():
+    '''
+    Test `Waiters.cancel` forgets the request.
+    '''
+    waiters = Waiters()
+    waiter = waiters.register(1)
+    waiters.cancel(waiter)
+
+    assert len(waiters) == 0
+    assert not waiters.dispatch({'id': 1})